@@ -1,8 +1,30 @@
 """
 Сервис интеграции с OpenAI
 """
+import asyncio
+import logging
+import random
+import time
+
+import openai
 from openai import AsyncOpenAI
 import config
+import database as db
+import metrics
+from circuit_breaker import breaker, CircuitOpenError
+from hedging import hedge_policy
+from http_pool import build_http_client, warm_up
+from long_memory import long_memory, format_snippets
+from model_router import router, detect_task
+from overload import overload, SHORT_ANSWERS, CHEAP_MODEL, NO_HISTORY
+from response_cache import response_cache, near_cache, make_key, make_scope, is_cacheable
+from rate_limiter import rate_limiter
+from scheduler import scheduler
+from singleflight import singleflight
+import tracing
+from user_locks import user_locks
+
+logger = logging.getLogger(__name__)
 
 # Ленивая инициализация клиента
 _client = None
@@ -10,9 +32,20 @@ _client = None
 def get_client():
     global _client
     if _client is None:
-        _client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+        # Повторы делает _complete, встроенные повторы клиента отключены
+        _client = AsyncOpenAI(
+            api_key=config.OPENAI_API_KEY,
+            base_url=config.OPENAI_BASE_URL,
+            max_retries=0,
+            http_client=build_http_client()
+        )
     return _client
 
+
+async def warm_up_client():
+    """Создать клиента и заранее открыть соединения с OpenAI"""
+    await warm_up(get_client(), config.OPENAI_PREWARM_CONNECTIONS)
+
 # Системный промпт для бота
 SYSTEM_PROMPT = """Ты — NeuralBot, дружелюбный и умный AI-ассистент в Telegram.
 Твоя задача — помогать пользователям с любыми вопросами.
@@ -34,50 +67,491 @@ SYSTEM_PROMPT = """Ты — NeuralBot, дружелюбный и умный AI-
 - Любыми вопросами пользователей"""
 
 
+# Системное сообщение собирается один раз: неизменный префикс промпта
+# позволяет OpenAI переиспользовать его кэш между запросами
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Компактные промпты режимов (config.MODES): для частых задач
+# не нужно отправлять весь общий промпт
+MODE_PROMPTS = {
+    "translate": """Ты — переводчик. Переведи текст пользователя: с русского и узбекского — на английский, с других языков — на русский, если пользователь не указал язык. Ответ — только перевод, без пояснений, с сохранением форматирования.""",
+    "code": """Ты — опытный программист. Отвечай по делу: код в блоках ``` с указанием языка и краткое пояснение на языке пользователя.""",
+    "write": """Ты — копирайтер и редактор. Пиши тексты, посты и статьи по заданию пользователя: грамотно, живо, с понятной структурой, на языке пользователя.""",
+    "chat": """Ты — NeuralBot, дружелюбный собеседник в Telegram. Отвечай коротко, на языке пользователя, эмодзи в меру.""",
+}
+
+SYSTEM_MESSAGES = {"auto": SYSTEM_MESSAGE}
+SYSTEM_MESSAGES.update(
+    (mode, {"role": "system", "content": prompt}) for mode, prompt in MODE_PROMPTS.items()
+)
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """Грубая оценка числа токенов в сообщениях (кириллица ~3 символа на токен)"""
+    return sum(len(m["content"]) // 3 + 4 for m in messages) + 3
+
+
 # Хранение контекста диалогов (в памяти)
 conversation_history: dict[int, list] = {}
 
+# Сколько раз пользователь очищал историю: задание, поставленное до /clear,
+# несет старое значение и не выполняется
+_clear_counts: dict[int, int] = {}
+
+
+def clear_count(user_id: int) -> int:
+    return _clear_counts.get(user_id, 0)
+
+# Счетчики запросов к OpenAI
+_stats = {"retries": 0, "history_compactions": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+
+def _openai_stats() -> dict:
+    result = dict(_stats)
+    prompt_tokens = _stats["prompt_tokens"]
+    result["prompt_cache_ratio"] = _stats["cached_tokens"] / prompt_tokens if prompt_tokens else 0.0
+    return result
 
-async def get_ai_response(user_id: int, message: str) -> str:
-    """Получить ответ от AI"""
+metrics.register("openai_calls", _openai_stats)
+
+
+def _uses_history(mode: str) -> bool:
+    return config.MODES[mode]["history"] if mode in config.MODES else True
+
+
+def estimate_request_tokens(user_id: int, message: str, mode: str = "auto") -> int:
+    """Оценка расхода токенов запроса до его выполнения (для дневного бюджета)"""
+    history = []
+    history_allowance = 0
+    if _uses_history(mode):
+        if config.AI_JOB_BACKEND == "sqlite":
+            # История хранится в процессах-воркерах, здесь ее нет: резервируем
+            # фиксированный запас, после ответа резерв заменится фактическим расходом
+            history_allowance = config.TOKEN_QUOTA_HISTORY_ESTIMATE
+        else:
+            history = conversation_history.get(user_id, [])
+    system_message = SYSTEM_MESSAGES.get(mode, SYSTEM_MESSAGE)
+    messages = [system_message] + history + [{"role": "user", "content": message}]
+    return estimate_tokens(messages) + history_allowance + config.TOKEN_QUOTA_COMPLETION_ESTIMATE
+
+
+async def get_ai_response(user_id: int, message: str, is_premium: bool = False,
+                          mode: str = "auto") -> tuple[bool, str, int]:
+    """
+    Получить ответ от AI в режиме mode (config.MODES или "auto").
+    Возвращает (успех, текст, израсходовано токенов); при неудаче текст —
+    сообщение об ошибке, и запрос не должен списываться из лимита.
+    Если у пользователя уже идет запрос, действует политика USER_REQUEST_POLICY
+    (при reject выбрасывается UserBusyError).
+    """
+    # Запросы одного пользователя не должны одновременно менять его историю
+    waited = time.monotonic()
+    async with user_locks.hold(user_id):
+        tracing.add("user_lock_wait", time.monotonic() - waited)
+        return await _generate(user_id, message, is_premium, mode)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Ошибки, после которых имеет смысл повторить запрос"""
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in config.OPENAI_RETRY_STATUSES
+    return False
+
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """Пауза перед повтором: Retry-After от OpenAI или экспонента со случайным разбросом"""
+    if isinstance(error, openai.APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            return min(float(retry_after), config.OPENAI_RETRY_MAX_DELAY)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(config.OPENAI_RETRY_MAX_DELAY, config.OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def _acquire(messages: list[dict], max_tokens: int) -> list:
+    """Дождаться места в лимитах аккаунта (TPM считает и запрошенный max_tokens)"""
+    return await rate_limiter.acquire(estimate_tokens(messages) + max_tokens)
+
+
+async def _stream(messages: list[dict], model: str, max_tokens: int, reservation: list,
+                  first_token: asyncio.Event, progress: dict = None) -> dict:
+    """
+    Потоковый запрос к OpenAI (место в лимитах уже получено); событие отмечает
+    первый токен, в progress пишется, сколько уже сгенерировано (на случай отмены)
+    """
+    progress = progress if progress is not None else {}
+    started = time.monotonic()
+    # Запрос считается отправленным заранее: отмена во время отправки
+    # не гарантирует, что OpenAI его не получил
+    progress["sent"] = True
+    raw = await get_client().chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=0.7,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    rate_limiter.update_from_headers(raw.headers)
+    stream = raw.parse()
+    
+    parts = []
+    usage = None
+    ttft = None
+    finish_reason = None
     try:
-        # Получаем или создаем историю диалога
-        if user_id not in conversation_history:
-            conversation_history[user_id] = []
-        
-        history = conversation_history[user_id]
-        
-        # Добавляем сообщение пользователя
-        history.append({"role": "user", "content": message})
-        
-        # Ограничиваем историю последними 10 сообщениями
-        if len(history) > 20:
-            history = history[-20:]
-            conversation_history[user_id] = history
+        async for chunk in stream:
+            if chunk.usage:
+                usage = progress["usage"] = chunk.usage
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if chunk.choices and chunk.choices[0].delta.content:
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                    hedge_policy.observe_ttft(model, ttft)
+                    router.observe(model, ttft)
+                    overload.observe_ttft(ttft)
+                    first_token.set()
+                parts.append(chunk.choices[0].delta.content)
+                progress["chars"] = progress.get("chars", 0) + len(parts[-1])
+    finally:
+        # Закрываем соединение и при отмене (проигравший резервный запрос)
+        await stream.close()
+    
+    if usage:
+        rate_limiter.settle(reservation, usage.total_tokens)
+    return {
+        "text": "".join(parts),
+        "model": model,
+        "usage": usage,
+        "finish_reason": finish_reason,
+        "ttft": ttft,
+        "elapsed": time.monotonic() - started,
+    }
+
+
+async def _wait_event(event: asyncio.Event, task: asyncio.Task, timeout: float = None) -> bool:
+    """Дождаться события или завершения задачи; False — истек таймаут"""
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        done, _ = await asyncio.wait({waiter, task}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+    return bool(done)
+
+
+async def _race(candidates: dict[asyncio.Task, asyncio.Event]) -> asyncio.Task:
+    """Задача, первой получившая первый токен (или успешно завершившаяся)"""
+    error = None
+    while candidates:
+        waiters = {asyncio.ensure_future(event.wait()): task for task, event in candidates.items()}
+        try:
+            done, _ = await asyncio.wait([*waiters, *candidates], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        for item in done:
+            task = waiters.get(item, item)
+            if task not in candidates:
+                continue
+            if task.done() and task.exception() is not None:
+                error = task.exception()
+                del candidates[task]
+            else:
+                return task
+    raise error
+
+
+async def _backup_stream(messages: list[dict], model: str, max_tokens: int,
+                         first_token: asyncio.Event, progress: dict) -> dict:
+    """Резервный запрос: сам ждет места в лимитах"""
+    reservation = await _acquire(messages, max_tokens)
+    return await _stream(messages, model, max_tokens, reservation, first_token, progress)
+
+
+def _spent(messages: list[dict], model: str, progress: dict):
+    """Расход отмененного запроса: фактический, если OpenAI успел его прислать, иначе оценка"""
+    if not progress.get("sent"):
+        return None
+    usage = progress.get("usage")
+    if usage:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (details.cached_tokens or 0) if details else 0
+        return {
+            "model": model,
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "cached_tokens": cached_tokens,
+        }
+    # Промпт оплачивается целиком, ответ — сколько успело сгенерироваться
+    return {
+        "model": model,
+        "prompt_tokens": estimate_tokens(messages),
+        "completion_tokens": progress.get("chars", 0) // 3,
+        "cached_tokens": 0,
+    }
+
+
+async def _hedged(messages: list[dict], model: str, max_tokens: int, reservation: list) -> dict:
+    """
+    Запрос с хеджированием: если первый токен не пришел к дедлайну, запускается
+    резервный запрос (модель из MODEL_FALLBACKS или та же), побеждает первый
+    ответивший, второй отменяется сразу. Расход проигравшего возвращается
+    в result["hedge_loser"].
+    """
+    first_token, primary_progress = asyncio.Event(), {}
+    primary = asyncio.create_task(
+        _stream(messages, model, max_tokens, reservation, first_token, primary_progress)
+    )
+    tasks = [primary]
+    try:
+        if not config.HEDGE_ENABLED:
+            return await primary
         
-        # Формируем сообщения для API
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history
+        hedge_policy.track_request()
+        # Место в лимитах уже получено: дедлайн отсчитывается с момента отправки
+        if await _wait_event(first_token, primary, hedge_policy.deadline(model)) or not hedge_policy.allow():
+            return await primary
         
-        # Запрос к OpenAI
-        response = await get_client().chat.completions.create(
-            model=config.GPT_MODEL,
-            messages=messages,
-            max_tokens=2000,
-            temperature=0.7
+        backup_model = config.MODEL_FALLBACKS.get(model, model)
+        backup_first_token, backup_progress = asyncio.Event(), {}
+        backup = asyncio.create_task(
+            _backup_stream(messages, backup_model, max_tokens, backup_first_token, backup_progress)
         )
+        tasks.append(backup)
         
-        assistant_message = response.choices[0].message.content
-        
-        # Добавляем ответ в историю
-        history.append({"role": "assistant", "content": assistant_message})
+        winner = await _race({primary: first_token, backup: backup_first_token})
+        if winner is backup:
+            loser, loser_model, loser_progress = primary, model, primary_progress
+        else:
+            loser, loser_model, loser_progress = backup, backup_model, backup_progress
+        # Проигравший отменяем сразу, а не когда победитель допишет ответ:
+        # иначе оба генерируют (и оплачиваются) целиком
+        loser.cancel()
+        await asyncio.wait({loser})
+        if not loser.cancelled():
+            loser.exception()  # Ошибка проигравшего уже не важна
+        spent = _spent(messages, loser_model, loser_progress)
+        hedge_policy.record_winner(
+            winner is backup, spent["prompt_tokens"] + spent["completion_tokens"] if spent else 0
+        )
+        result = await winner
+        result["hedge_loser"] = spent
+        return result
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def _complete(messages: list[dict], model: str, max_tokens: int, tier: str) -> dict:
+    """Запрос к OpenAI с таймаутом попытки, повторами и предохранителем"""
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError()
         
-        return assistant_message
+        try:
+            # Premium-запросы получают место в пуле раньше бесплатных
+            waited = time.monotonic()
+            async with scheduler.slot(tier):
+                tracing.add("scheduler_wait", time.monotonic() - waited)
+                # Ожидание в собственных лимитах RPM/TPM — не сбой OpenAI:
+                # оно не входит в таймаут попытки и не учитывается предохранителем
+                with tracing.span("rate_limit_wait"):
+                    reservation = await _acquire(messages, max_tokens)
+                result = await asyncio.wait_for(
+                    _hedged(messages, model, max_tokens, reservation),
+                    timeout=config.OPENAI_TIMEOUT
+                )
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                router.observe(model, config.OPENAI_TIMEOUT)
+                overload.observe_ttft(config.OPENAI_TIMEOUT)
+            if not _is_retryable(e):
+                # OpenAI доступен, ошибка в самом запросе
+                if isinstance(e, openai.APIStatusError):
+                    breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt >= config.OPENAI_MAX_RETRIES:
+                raise
+            with tracing.span("retry_backoff"):
+                await asyncio.sleep(_retry_delay(attempt, e))
+            attempt += 1
+            _stats["retries"] += 1
+            continue
         
+        breaker.record_success()
+        # Этапы выигравшего запроса; пустой ответ целиком считаем ожиданием
+        ttft = result["ttft"] if result["ttft"] is not None else result["elapsed"]
+        tracing.add("openai_ttft", ttft)
+        tracing.add("openai_generation", result["elapsed"] - ttft)
+        return result
+
+
+def _compact_history(history: list):
+    """Сжать историю на месте, сохранив последние сообщения и начав с реплики пользователя"""
+    del history[:-config.HISTORY_COMPACT_TO]
+    while history and history[0]["role"] != "user":
+        del history[0]
+    _stats["history_compactions"] += 1
+
+
+async def _remember(user_id: int, message: str, answer: str):
+    """Сохранить пару в долговременную память (сбой памяти не ломает ответ)"""
+    if not config.MEMORY_ENABLED:
+        return
+    try:
+        await long_memory.remember(user_id, message, answer)
     except Exception as e:
-        return f"❌ Произошла ошибка: {str(e)}\n\nПопробуйте еще раз или обратитесь в поддержку."
+        logger.error(f"Failed to store long-term memory: {e}")
+
+
+def _forget_turn(history: list, user_turn: dict):
+    """Неудачный или отмененный запрос не оставляет в истории вопрос без ответа"""
+    if history and history[-1] is user_turn:
+        history.pop()
+
+
+async def _generate(user_id: int, message: str, is_premium: bool, mode: str) -> tuple[bool, str, int]:
+    """Запрос к AI с учетом истории диалога"""
+    # При сильной перегрузке бесплатные запросы не выполняются
+    if overload.should_shed(is_premium):
+        return False, config.TEXTS["overloaded"], 0
+    level = overload.level
+    
+    # Получаем или создаем историю диалога
+    if user_id not in conversation_history:
+        conversation_history[user_id] = []
+    
+    history = conversation_history[user_id]
+    system_message = SYSTEM_MESSAGES.get(mode, SYSTEM_MESSAGE)
+    system_prompt = system_message["content"]
+    tier = "premium" if is_premium else "free"
+    
+    # Добавляем сообщение пользователя
+    user_turn = {"role": "user", "content": message}
+    history.append(user_turn)
+    
+    # Историю только дописываем в конец, чтобы префикс промпта оставался
+    # байт-в-байт прежним (кэш промптов OpenAI). Когда она вырастает до
+    # HISTORY_MAX_MESSAGES, разом сжимаем ее до HISTORY_COMPACT_TO сообщений
+    if len(history) > config.HISTORY_MAX_MESSAGES:
+        _compact_history(history)
+    
+    # Формируем сообщения для API. Фрагменты прошлых разговоров вставляются перед
+    # новым вопросом: префикс из системного промпта и истории не меняется
+    messages = [system_message] + history
+    if level >= NO_HISTORY or not _uses_history(mode):
+        # Перегрузка или режим без контекста: только вопрос,
+        # история сохраняется для следующих ответов
+        messages = [system_message, user_turn]
+    elif config.MEMORY_ENABLED:
+        answered = sum(1 for item in history if item["role"] == "assistant")
+        with tracing.span("memory_recall"):
+            snippets = await long_memory.recall(user_id, message, exclude_recent=answered)
+        if snippets:
+            messages.insert(-1, format_snippets(snippets))
+    task = config.MODES[mode]["task"] if mode in config.MODES else detect_task(message)
+    prompt_tokens = estimate_tokens(messages)
+    model = router.route(user_id, tier, task, prompt_tokens, mode)
+    if level >= CHEAP_MODEL and tier == "free":
+        model = config.OVERLOAD_FREE_MODEL
+    
+    # Сообщение без контекста (только промпт и вопрос) одинаково для всех
+    # пользователей: его можно взять из кэша или дождаться такого же запроса,
+    # уже идущего к AI
+    cache_key = None
+    if len(messages) == 2 and is_cacheable(message):
+        cache_key = make_key(model, system_prompt, message)
+    if config.RESPONSE_CACHE_ENABLED and cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is None and config.NEAR_CACHE_ENABLED:
+            match = near_cache.lookup(make_scope(model, system_prompt), message)
+            if match is not None:
+                cached = match[0]
+        if cached is not None:
+            history.append({"role": "assistant", "content": cached})
+            await _remember(user_id, message, cached)
+            return True, cached, 0
+    
+    try:
+        max_tokens = router.max_tokens(model, tier, task, prompt_tokens, mode)
+        if level >= SHORT_ANSWERS:
+            max_tokens = max(int(max_tokens * config.OVERLOAD_MAX_TOKENS_FACTOR), config.MIN_MAX_TOKENS)
+        shared = False
+        if cache_key is not None and config.SINGLEFLIGHT_ENABLED:
+            result, shared = await singleflight.do(
+                f"{cache_key}:{max_tokens}",
+                lambda: _complete(messages, model, max_tokens, tier)
+            )
+        else:
+            result = await _complete(messages, model, max_tokens, tier)
+    except CircuitOpenError:
+        _forget_turn(history, user_turn)
+        return False, "⚠️ AI временно перегружен. Попробуйте через минуту — запрос не списан.", 0
+    except asyncio.TimeoutError:
+        _forget_turn(history, user_turn)
+        return False, "⌛ AI не ответил вовремя. Попробуйте еще раз — запрос не списан.", 0
+    except Exception as e:
+        _forget_turn(history, user_turn)
+        return False, f"❌ Произошла ошибка: {str(e)}\n\nПопробуйте еще раз или обратитесь в поддержку.", 0
+    except asyncio.CancelledError:
+        _forget_turn(history, user_turn)
+        raise
+    
+    assistant_message = result["text"]
+    
+    # Ответ попадает в историю до первого await: отмена после этой точки
+    # не оставит в истории вопрос без ответа
+    history.append({"role": "assistant", "content": assistant_message})
+    
+    # Учитываем фактический расход токенов (чужой ответ, как из кэша, не списывается)
+    usage = None if shared else result["usage"]
+    loser = None if shared else result.get("hedge_loser")
+    if loser:
+        # Проигравший запрос хеджирования пользователю не списывается, но стоит денег
+        await db.record_token_usage(
+            user_id, loser["model"], tier, "hedge",
+            loser["prompt_tokens"], loser["completion_tokens"], loser["cached_tokens"], 0
+        )
+    if usage:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (details.cached_tokens or 0) if details else 0
+        _stats["prompt_tokens"] += usage.prompt_tokens
+        _stats["cached_tokens"] += cached_tokens
+        with tracing.span("db_usage"):
+            await db.record_token_usage(
+                user_id, result["model"], tier, task,
+                usage.prompt_tokens, usage.completion_tokens,
+                cached_tokens, int(result["elapsed"] * 1000)
+            )
+    
+    await _remember(user_id, message, assistant_message)
+    
+    # Ответ, обрезанный по max_tokens (тариф, перегрузка), в кэш не попадает:
+    # иначе его получили бы и пользователи с большим лимитом
+    cacheable = assistant_message and not shared and result["finish_reason"] != "length"
+    if config.RESPONSE_CACHE_ENABLED and cache_key is not None and cacheable:
+        response_cache.set(cache_key, assistant_message)
+        if config.NEAR_CACHE_ENABLED:
+            near_cache.add(make_scope(model, system_prompt), message, assistant_message)
+    
+    return True, assistant_message, usage.total_tokens if usage else 0
 
 
-def clear_history(user_id: int):
-    """Очистить историю диалога"""
+async def clear_history(user_id: int):
+    """
+    Очистить историю диалога и долговременную память. Идущие запросы
+    пользователя отменяются: их ответ уже никто не ждет, и они не списываются
+    """
+    _clear_counts[user_id] = clear_count(user_id) + 1
+    user_locks.cancel(user_id)
     if user_id in conversation_history:
         del conversation_history[user_id]
+    if config.MEMORY_ENABLED:
+        await long_memory.forget(user_id)
@@ -2,18 +2,23 @@
 NeuralBot - AI-ассистент в Telegram с монетизацией
 Главный модуль бота (версия для Узбекистана)
 """
+import argparse
 import asyncio
 import logging
+import time
 from datetime import datetime
+from typing import Optional
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import Message, CallbackQuery
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest
 
 import config
 import database as db
+import metrics
 from keyboards import (
     get_main_keyboard, 
     get_subscription_keyboard, 
@@ -23,8 +28,18 @@ from keyboards import (
     get_limit_keyboard,
     get_admin_keyboard
 )
-from ai_service import get_ai_response, clear_history
+from ai_service import get_ai_response, clear_history, clear_count, estimate_request_tokens, warm_up_client
+from coalescer import coalescer
+from faq import faq_index
+from overload import overload
+from job_queue import ai_jobs, QueueFullError
+import durable_jobs
+import metrics_server
+import tracing
+from tracing import latency
+from user_locks import UserBusyError
 import payments
+from telegram_format import render, to_plain
 
 # Настройка логирования
 logging.basicConfig(
@@ -99,6 +114,11 @@ async def cmd_help(message: Message):
 /premium — Подписка Premium
 /referral — Пригласить друга
 /clear — Очистить контекст диалога
+/merge — Объединять сообщения, отправленные подряд
+/translate — Режим перевода
+/code — Режим программирования
+/write — Режим текстов
+/chat — Режим общения
 /help — Эта справка
 
 <b>Что я умею:</b>
@@ -120,10 +140,56 @@ async def cmd_help(message: Message):
 @dp.message(Command("clear"))
 async def cmd_clear(message: Message):
     """Очистка истории диалога"""
-    clear_history(message.from_user.id)
+    if config.AI_JOB_BACKEND == "sqlite":
+        # История хранится в процессе-воркере: очищаем ее заданием в общей очереди,
+        # а еще не взятые воркером сообщения отменяем сразу
+        await db.cancel_queued_ai_jobs(message.from_user.id)
+        await db.enqueue_ai_job({"kind": "clear", "user_id": message.from_user.id, "chat_id": message.chat.id})
+    else:
+        await clear_history(message.from_user.id)
     await message.answer("🗑 История диалога очищена. Начнем с чистого листа!")
 
 
+@dp.message(Command("merge"))
+async def cmd_merge(message: Message):
+    """Включение/выключение объединения сообщений"""
+    user_id = message.from_user.id
+    user = await db.get_user(user_id)
+    
+    if not user:
+        await message.answer("Профиль не найден. Используйте /start")
+        return
+    
+    enabled = not user.get("merge_messages")
+    await db.set_merge_messages(user_id, enabled)
+    
+    if enabled:
+        await message.answer(
+            "🧩 <b>Объединение сообщений включено</b>\n\n"
+            f"Сообщения, отправленные с паузой меньше {config.MERGE_WINDOW_MS / 1000:g} сек, "
+            "я обработаю как один вопрос и отвечу один раз."
+        )
+    else:
+        await message.answer("🧩 Объединение сообщений выключено. Отвечаю на каждое сообщение.")
+
+
+@dp.message(Command(*config.MODES))
+async def cmd_mode(message: Message, command: CommandObject):
+    """Включение режима; повторная команда возвращает обычный режим"""
+    user_id = message.from_user.id
+    user = await db.get_user(user_id)
+    
+    if not user:
+        await message.answer("Профиль не найден. Используйте /start")
+        return
+    
+    mode = command.command
+    if user.get("mode") == mode:
+        mode = "auto"
+    await db.set_user_mode(user_id, mode)
+    await message.answer(config.TEXTS[f"mode_{mode}"])
+
+
 @dp.message(Command("profile"))
 @dp.message(F.text == "👤 Профиль")
 async def cmd_profile(message: Message):
@@ -138,10 +204,17 @@ async def cmd_profile(message: Message):
     has_premium = await db.has_active_subscription(user_id)
     expires = await db.get_subscription_expires(user_id)
     
-    today_usage = await db.get_today_usage(user_id)
-    remaining = config.FREE_QUERIES_PER_DAY - today_usage + user.get("bonus_queries", 0)
-    if has_premium:
-        remaining = "∞"
+    if config.QUOTA_MODE == "tokens":
+        token_limit = config.PREMIUM_TOKENS_PER_DAY if has_premium else config.FREE_TOKENS_PER_DAY
+        remaining_tokens = max(token_limit - await db.get_today_tokens(user_id), 0)
+        remaining = f"{remaining_tokens:,} токенов"
+        if user.get("bonus_queries", 0):
+            remaining += f" + {user['bonus_queries']} бонусных запросов"
+    else:
+        today_usage = await db.get_today_usage(user_id)
+        remaining = config.FREE_QUERIES_PER_DAY - today_usage + user.get("bonus_queries", 0)
+        if has_premium:
+            remaining = "∞"
     
     reg_date = user.get("registered_at", "")
     if reg_date:
@@ -220,6 +293,15 @@ async def cmd_admin(message: Message):
     await message.answer("🔐 <b>Админ панель</b>", reply_markup=get_admin_keyboard())
 
 
+@dp.message(Command("latency"))
+async def cmd_latency(message: Message):
+    """Задержка обработки сообщений по этапам (для админа)"""
+    if message.from_user.id != config.ADMIN_ID:
+        return
+    
+    await message.answer(latency.report())
+
+
 @dp.callback_query(F.data == "admin:stats")
 async def admin_stats(callback: CallbackQuery):
     """Статистика для админа"""
@@ -234,6 +316,42 @@ async def admin_stats(callback: CallbackQuery):
     await callback.answer()
 
 
+@dp.callback_query(F.data == "admin:costs")
+async def admin_costs(callback: CallbackQuery):
+    """Расходы на AI для админа"""
+    if callback.from_user.id != config.ADMIN_ID:
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+    
+    by_plan = await db.get_token_costs("plan", days=30)
+    by_day = await db.get_token_costs("day", days=7)
+    by_user = await db.get_token_costs("user", days=1, limit=5)
+    by_task = await db.get_token_costs("task", days=30)
+    
+    lines = ["💰 <b>Расходы на AI</b>", "", "<b>По тарифам (30 дней):</b>"]
+    lines += [f"• {row['plan']}: ${row['cost']:.2f} ({row['requests']} запр.)" for row in by_plan]
+    lines += ["", "<b>По задачам (30 дней):</b>"]
+    lines += [f"• {row['task']}: ${row['cost']:.2f} ({row['requests']} запр.)" for row in by_task]
+    lines += ["", "<b>По дням:</b>"]
+    lines += [f"• {row['day']}: ${row['cost']:.2f} ({row['requests']} запр.)" for row in sorted(by_day, key=lambda row: row["day"])]
+    lines += ["", "<b>Топ пользователей за сутки:</b>"]
+    lines += [f"• <code>{row['user']}</code>: ${row['cost']:.3f} ({row['requests']} запр.)" for row in by_user]
+    
+    await callback.message.edit_text("\n".join(lines), reply_markup=get_admin_keyboard())
+    await callback.answer()
+
+
+@dp.callback_query(F.data == "admin:perf")
+async def admin_perf(callback: CallbackQuery):
+    """Метрики производительности для админа"""
+    if callback.from_user.id != config.ADMIN_ID:
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+    
+    await callback.message.edit_text(metrics.format_report(), reply_markup=get_admin_keyboard())
+    await callback.answer()
+
+
 # ==================== ОПЛАТА ====================
 
 @dp.callback_query(F.data == "subscription")
@@ -441,25 +559,97 @@ async def callback_menu(callback: CallbackQuery):
 
 # ==================== ОБРАБОТКА СООБЩЕНИЙ ====================
 
+# Клавиатуры к готовым ответам faq.py
+FAQ_KEYBOARDS = {
+    "subscription": get_subscription_keyboard,
+    "limit": get_limit_keyboard,
+}
+
+
+async def send_ai_response(chat_id: int, text: str):
+    """Отправить ответ AI: Markdown -> HTML, длинный ответ — несколькими сообщениями"""
+    for chunk in render(text):
+        try:
+            await bot.send_message(chat_id, chunk)
+        except TelegramBadRequest as e:
+            logger.warning(f"Telegram rejected rendered HTML, sending plain text: {e}")
+            await bot.send_message(chat_id, to_plain(chunk), parse_mode=None)
+
+
+async def submit_ai_job(job: dict) -> int:
+    """Поставить задание в очередь выбранного хранилища (AI_JOB_BACKEND)"""
+    if config.AI_JOB_BACKEND == "sqlite":
+        return await durable_jobs.submit(job)
+    # Задание, дождавшееся очереди уже после /clear, не выполняется (process_ai_job)
+    job["clears"] = clear_count(job["user_id"])
+    return ai_jobs.submit(job)
+
+
 @dp.message(F.text)
 async def handle_message(message: Message):
     """Обработка текстовых сообщений (AI)"""
     user_id = message.from_user.id
     user_text = message.text
+    # Трассировка учитывается, только если сообщение дошло до AI
+    trace = tracing.start("message", user_id)
     
     # Проверяем пользователя
-    user = await db.get_user(user_id)
-    if not user:
-        await db.create_user(
-            user_id, 
-            message.from_user.username or "", 
-            message.from_user.first_name or ""
-        )
+    with tracing.span("db_user"):
+        user = await db.get_user(user_id)
+        if not user:
+            await db.create_user(
+                user_id, 
+                message.from_user.username or "", 
+                message.from_user.first_name or ""
+            )
+    
+    # Сообщения, отправленные подряд, отвечаем одним запросом
+    if user and user.get("merge_messages"):
+        with tracing.span("merge_wait"):
+            user_text = await coalescer.collect(user_id, user_text)
+        if user_text is None:
+            return
+    
+    mode = (user.get("mode") or "auto") if user else "auto"
+    
+    # Вопросы о самом боте: готовый ответ без AI и без списания лимита
+    # (в режимах перевода, кода и текстов сообщение — задание для AI)
+    if config.FAQ_ENABLED and mode in ("auto", "chat"):
+        entry = faq_index.match(user_text)
+        if entry:
+            keyboard = FAQ_KEYBOARDS[entry["keyboard"]]() if entry["keyboard"] else None
+            await message.answer(entry["answer"], reply_markup=keyboard)
+            return
     
     # Проверяем подписку
+    checks_started = time.monotonic()
     has_premium = await db.has_active_subscription(user_id)
     
-    if not has_premium:
+    # При сильной перегрузке бесплатные запросы не ставим в очередь
+    if overload.should_shed(has_premium):
+        await message.answer(config.TEXTS["overloaded"])
+        return
+    
+    # Проверяем лимит: по числу запросов или по дневному бюджету токенов
+    use_bonus = False
+    reserved_tokens = 0
+    if config.QUOTA_MODE == "tokens":
+        token_limit = config.PREMIUM_TOKENS_PER_DAY if has_premium else config.FREE_TOKENS_PER_DAY
+        estimate = estimate_request_tokens(user_id, user_text, mode)
+        if await db.reserve_tokens(user_id, estimate, token_limit):
+            reserved_tokens = estimate
+        else:
+            user_data = await db.get_user(user_id)
+            bonus = user_data.get("bonus_queries", 0) if user_data else 0
+            if has_premium or bonus <= 0:
+                limit_text = config.TEXTS["token_limit_reached"].format(
+                    token_limit=token_limit,
+                    referral_bonus=config.REFERRAL_BONUS
+                )
+                await message.answer(limit_text, reply_markup=get_limit_keyboard())
+                return
+            use_bonus = True
+    elif not has_premium:
         today_usage = await db.get_today_usage(user_id)
         user_data = await db.get_user(user_id)
         bonus = user_data.get("bonus_queries", 0) if user_data else 0
@@ -472,20 +662,123 @@ async def handle_message(message: Message):
             await message.answer(limit_text, reply_markup=get_limit_keyboard())
             return
         
-        if today_usage >= config.FREE_QUERIES_PER_DAY:
-            await db.use_bonus_query(user_id)
-    
-    # Показываем "печатает..."
-    await bot.send_chat_action(user_id, "typing")
-    
-    # Получаем ответ от AI
-    response = await get_ai_response(user_id, user_text)
+        use_bonus = today_usage >= config.FREE_QUERIES_PER_DAY
+    tracing.add("db_quota", time.monotonic() - checks_started)
+    
+    job = {
+        "user_id": user_id,
+        "chat_id": message.chat.id,
+        "text": user_text,
+        "is_premium": has_premium,
+        "use_bonus": use_bonus,
+        "reserved_tokens": reserved_tokens,
+        "mode": mode,
+        "trace": trace,
+    }
+    try:
+        with tracing.span("enqueue"):
+            position = await submit_ai_job(job)
+    except QueueFullError:
+        if reserved_tokens:
+            await db.release_tokens(user_id, reserved_tokens)
+        await message.answer(config.TEXTS["queue_full"])
+        return
     
-    # Увеличиваем счетчик
-    await db.increment_usage(user_id)
+    # Показываем "печатает..." или место в очереди
+    with tracing.span("send_chat_action"):
+        if position:
+            await message.answer(config.TEXTS["queue_wait"].format(position=position))
+        else:
+            await bot.send_chat_action(user_id, "typing")
+    if config.AI_JOB_BACKEND == "sqlite":
+        # Остальные этапы считает процесс-воркер
+        latency.finish(trace)
+
+
+async def run_ai_job(job: dict) -> tuple[bool, Optional[str], int]:
+    """Выполнить задание: (успех, ответ, токены). Ответ None — отправлять нечего"""
+    if job.get("kind") == "clear":
+        await clear_history(job["user_id"])
+        return True, None, 0
+    try:
+        return await get_ai_response(
+            job["user_id"], job["text"], is_premium=bool(job["is_premium"]), mode=job.get("mode") or "auto"
+        )
+    except UserBusyError:
+        return False, "⏳ Я еще отвечаю на ваше предыдущее сообщение. Подождите немного!", 0
+
+
+async def finish_ai_job(job: dict, success: bool, response: Optional[str], tokens: int):
+    """Списать лимит по результату задания и отправить ответ"""
+    if job.get("kind") == "clear":
+        return
+    user_id = job["user_id"]
+    reserved_tokens = job["reserved_tokens"]
+    
+    # Списываем запрос, только если AI ответил; резерв токенов заменяем фактическим расходом
+    with tracing.span("db_charge"):
+        if success:
+            if job["use_bonus"]:
+                await db.use_bonus_query(user_id)
+            await db.increment_usage(user_id, tokens - reserved_tokens)
+        elif reserved_tokens:
+            await db.release_tokens(user_id, reserved_tokens)
     
     # Отправляем ответ
-    await message.answer(response)
+    if response:
+        with tracing.span("send_answer"):
+            await send_ai_response(job["chat_id"], response)
+
+
+async def process_ai_job(job: dict):
+    """Задание из очереди в памяти: получить ответ от AI, списать лимит и ответить"""
+    # Задача воркера не наследует контекст обработчика сообщения
+    tracing.use(job.get("trace"))
+    tracing.add("queue_wait", time.monotonic() - job["enqueued_at"])
+    # После этой проверки запрос без await попадает в user_locks,
+    # и более поздний /clear отменяет его сам
+    if job["clears"] != clear_count(job["user_id"]):
+        await release_stale_ai_job(job)
+        return
+    try:
+        success, response, tokens = await run_ai_job(job)
+    except asyncio.CancelledError:
+        # Запрос отменен более новым сообщением — резерв возвращаем
+        if job["reserved_tokens"]:
+            await db.release_tokens(job["user_id"], job["reserved_tokens"])
+        raise
+    await finish_ai_job(job, success, response, tokens)
+    latency.finish(job.get("trace"))
+
+
+async def release_stale_ai_job(job: dict):
+    """Задание, поставленное до /clear: не списывается и не отвечается"""
+    logger.info(f"Dropping AI job of user {job['user_id']} queued before /clear")
+    if job["reserved_tokens"]:
+        await db.release_tokens(job["user_id"], job["reserved_tokens"])
+
+
+async def deliver_ai_job(job: dict):
+    """Задание, выполненное воркером-процессом: списать лимит и ответить"""
+    trace = tracing.start("delivery", job["user_id"])
+    await finish_ai_job(job, bool(job["success"]), job["response"], job["tokens"])
+    latency.finish(trace)
+
+
+async def run_traced_ai_job(job: dict) -> tuple[bool, Optional[str], int]:
+    """Задание в процессе-воркере с трассировкой этапов"""
+    trace = tracing.start("worker", job["user_id"])
+    tracing.add("queue_wait", max(time.time() - job["created_at"], 0.0))
+    result = await run_ai_job(job)
+    latency.finish(trace)
+    return result
+
+
+async def start_metrics_server(port: int):
+    """Локальный эндпоинт метрик, если задан METRICS_PORT"""
+    if not config.METRICS_PORT:
+        return None
+    return await metrics_server.start(config.METRICS_HOST, port)
 
 
 # ==================== ЗАПУСК ====================
@@ -495,11 +788,68 @@ async def main():
     logger.info("Initializing database...")
     await db.init_db()
     
+    logger.info("Warming up OpenAI connections...")
+    await warm_up_client()
+    
     logger.info("Starting NeuralBot (Uzbekistan version)...")
     
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    flusher = asyncio.create_task(db.token_usage_flusher())
+    overload.start()
+    metrics_runner = await start_metrics_server(config.METRICS_PORT)
+    if config.AI_JOB_BACKEND == "sqlite":
+        # Задания выполняют процессы "python bot.py --worker N", здесь только доставка
+        deliverer = durable_jobs.Deliverer(deliver_ai_job)
+        metrics.register("ai_jobs_db", deliverer.stats)
+        background = asyncio.create_task(deliverer.run())
+    else:
+        ai_jobs.start(process_ai_job)
+        background = None
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        overload.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if background:
+            background.cancel()
+        else:
+            # Невыполненные задания не списываются
+            for job in await ai_jobs.stop():
+                if job["reserved_tokens"]:
+                    await db.release_tokens(job["user_id"], job["reserved_tokens"])
+        flusher.cancel()
+        await db.flush_token_usage()
+
+
+async def run_worker(shard: int):
+    """Процесс-воркер очереди заданий в SQLite"""
+    await db.init_db()
+    await warm_up_client()
+    
+    worker = durable_jobs.DurableWorker(run_traced_ai_job, shard, config.AI_WORKER_SHARDS, config.AI_WORKERS)
+    metrics.register("ai_worker", worker.stats)
+    flusher = asyncio.create_task(db.token_usage_flusher())
+    overload.start()
+    # Каждому воркеру свой порт: METRICS_PORT + 1 + shard
+    metrics_runner = await start_metrics_server(config.METRICS_PORT + 1 + shard)
+    try:
+        await worker.run()
+    finally:
+        overload.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        flusher.cancel()
+        await db.flush_token_usage()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="NeuralBot")
+    parser.add_argument("--worker", type=int, metavar="SHARD",
+                        help="Запустить процесс-воркер очереди заданий (AI_JOB_BACKEND=sqlite)")
+    args = parser.parse_args()
+    
+    if args.worker is not None:
+        asyncio.run(run_worker(args.worker))
+    else:
+        asyncio.run(main())
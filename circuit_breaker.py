@@ -0,0 +1,85 @@
+"""
+Предохранитель для запросов к OpenAI: быстрый отказ, пока сервис деградирует
+"""
+import time
+
+import config
+import metrics
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут — запрос к OpenAI не отправляется"""
+
+
+class CircuitBreaker:
+    """
+    closed — запросы идут как обычно;
+    open — после failure_threshold ошибок подряд запросы сразу отклоняются;
+    half_open — по истечении cooldown пропускается один пробный запрос,
+    его успех замыкает предохранитель, ошибка снова размыкает.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self.opens = 0
+        self.rejected = 0
+        self.total_failures = 0
+        self.total_successes = 0
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос"""
+        now = time.monotonic()
+        if self.state == "open" and now - self._opened_at >= self.cooldown:
+            self.state = "half_open"
+            self._probe_started = None
+
+        if self.state == "closed":
+            return True
+
+        # Пробный запрос мог потеряться (отмена) — тогда через cooldown пускаем новый
+        if self.state == "half_open" and (
+            self._probe_started is None or now - self._probe_started >= self.cooldown
+        ):
+            self._probe_started = now
+            return True
+
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        """OpenAI ответил"""
+        self.total_successes += 1
+        self._failures = 0
+        self.state = "closed"
+        self._probe_started = None
+
+    def record_failure(self):
+        """OpenAI не ответил или ответил ошибкой сервера"""
+        self.total_failures += 1
+        self._failures += 1
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+
+    def stats(self) -> dict:
+        """Состояние предохранителя"""
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "failures": self.total_failures,
+            "successes": self.total_successes,
+        }
+
+
+breaker = CircuitBreaker(config.BREAKER_FAILURE_THRESHOLD, config.BREAKER_COOLDOWN)
+metrics.register("openai_breaker", breaker.stats)
@@ -0,0 +1,76 @@
+"""
+Объединение быстро отправленных подряд сообщений в один запрос к AI
+"""
+import asyncio
+import time
+from typing import Optional
+
+import config
+import metrics
+
+
+class _Batch:
+    def __init__(self, text: str):
+        self.parts = [text]
+        self.started = time.monotonic()
+        self.last = self.started
+
+
+class MessageCoalescer:
+    """
+    Первое сообщение пачки ждет, пока пользователь не замолчит на window секунд
+    (но не дольше max_wait), и возвращает весь накопленный текст. Остальные
+    сообщения пачки просто дописываются к ней.
+    """
+
+    def __init__(self, window: float, max_wait: float, max_messages: int):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._batches: dict[int, _Batch] = {}
+        self.batches = 0
+        self.merged = 0
+
+    async def collect(self, user_id: int, text: str) -> Optional[str]:
+        """Текст объединенного запроса или None, если сообщение ушло в чужую пачку"""
+        batch = self._batches.get(user_id)
+        if batch is not None:
+            batch.parts.append(text)
+            batch.last = time.monotonic()
+            self.merged += 1
+            if len(batch.parts) >= self.max_messages:
+                # Полная пачка больше не принимает сообщений
+                del self._batches[user_id]
+            return None
+
+        batch = _Batch(text)
+        self._batches[user_id] = batch
+        try:
+            while True:
+                deadline = min(batch.last + self.window, batch.started + self.max_wait)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or len(batch.parts) >= self.max_messages:
+                    break
+                await asyncio.sleep(remaining)
+        finally:
+            if self._batches.get(user_id) is batch:
+                del self._batches[user_id]
+
+        self.batches += 1
+        return "\n".join(batch.parts)
+
+    def stats(self) -> dict:
+        """Сколько запросов к AI сэкономлено"""
+        return {
+            "batches": self.batches,
+            "merged_messages": self.merged,
+            "pending": len(self._batches),
+        }
+
+
+coalescer = MessageCoalescer(
+    config.MERGE_WINDOW_MS / 1000,
+    config.MERGE_MAX_WAIT_MS / 1000,
+    config.MERGE_MAX_MESSAGES,
+)
+metrics.register("message_merge", coalescer.stats)
@@ -9,11 +9,154 @@ load_dotenv()
 # Telegram
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+TELEGRAM_MESSAGE_LIMIT = 4096  # Максимальная длина одного сообщения
 
 # OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Другой адрес API, например локальная заглушка mock_openai.py: http://127.0.0.1:8001/v1
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 GPT_MODEL = "gpt-4o-mini"  # Экономичная модель с хорошим качеством
 
+# Маршрутизация моделей: первое подходящее правило выбирает модель, иначе GPT_MODEL.
+# Условия правила (все необязательные): tier — "premium"/"free",
+# task — "code"/"translation"/"chat"/"general", min_tokens/max_tokens — оценка длины промпта
+MODEL_ROUTES = [
+    {"task": "chat", "model": "gpt-4o-mini"},
+    {"task": "translation", "model": "gpt-4o-mini"},
+    {"tier": "premium", "task": "code", "model": "gpt-4o"},
+    {"tier": "premium", "min_tokens": 1500, "model": "gpt-4o"},
+]
+# Если сглаженное время до первого токена модели выше MODEL_LATENCY_LIMIT секунд,
+# используется запасная (полное время ответа зависит от его длины и не показательно)
+MODEL_FALLBACKS = {"gpt-4o": "gpt-4o-mini"}
+MODEL_LATENCY_LIMIT = float(os.getenv("MODEL_LATENCY_LIMIT", "10"))
+MODEL_LATENCY_TTL = 120  # Через столько секунд без замеров модель снова пробуется
+
+# Лимит длины ответа (max_tokens): меньшее из значения для задачи, потолка тарифа
+# и места, оставшегося в контексте модели после промпта
+MAX_TOKENS_BY_TASK = {"chat": 300, "translation": 1000, "code": 2000, "general": 1200}
+MAX_TOKENS_BY_TIER = {"free": 1000, "premium": 4000}
+MODEL_CONTEXT_WINDOWS = {"gpt-4o-mini": 128000, "gpt-4o": 128000, "gpt-4.1-nano": 1047576}
+DEFAULT_CONTEXT_WINDOW = 16000
+CONTEXT_SAFETY_MARGIN = 200  # Запас на неточность оценки токенов
+MIN_MAX_TOKENS = 64
+
+# Режимы (/translate, /code, /write, /chat): компактный промпт (ai_service.MODE_PROMPTS),
+# модель по тарифам, лимит длины ответа и отправка истории диалога.
+# Без режима ("auto") — общий промпт, модель по MODEL_ROUTES и лимит по типу задачи
+MODES = {
+    "translate": {
+        "task": "translation",
+        "models": {"free": "gpt-4o-mini", "premium": "gpt-4o-mini"},
+        "max_tokens": 1000,
+        "history": False,  # Переводу контекст не нужен
+    },
+    "code": {
+        "task": "code",
+        "models": {"free": "gpt-4o-mini", "premium": "gpt-4o"},
+        "max_tokens": 2000,
+        "history": True,
+    },
+    "write": {
+        "task": "general",
+        "models": {"free": "gpt-4o-mini", "premium": "gpt-4o"},
+        "max_tokens": 1500,
+        "history": True,
+    },
+    "chat": {
+        "task": "chat",
+        "models": {"free": "gpt-4o-mini", "premium": "gpt-4o-mini"},
+        "max_tokens": 300,
+        "history": True,
+    },
+}
+
+# Пул HTTP-соединений с OpenAI
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "40"))  # Простаивающих соединений в запасе
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "90"))  # секунды
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "0") == "1"  # Требует пакет h2
+OPENAI_CONNECT_TIMEOUT = 5.0
+OPENAI_READ_TIMEOUT = 30.0  # Пауза между данными ответа
+OPENAI_POOL_TIMEOUT = 10.0  # Ожидание свободного соединения
+OPENAI_PREWARM_CONNECTIONS = int(os.getenv("OPENAI_PREWARM_CONNECTIONS", "2"))
+
+# Лимиты аккаунта OpenAI (уточняются по заголовкам x-ratelimit-*)
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+
+# Таймауты, повторы и предохранитель запросов к OpenAI
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))  # Таймаут одной попытки, секунды
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_RETRY_BASE_DELAY = 0.5  # секунды
+OPENAI_RETRY_MAX_DELAY = 8.0
+OPENAI_RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))  # Ошибок подряд до размыкания
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))  # Секунды до пробного запроса
+
+# Хеджирование: если первый токен не пришел к дедлайну (перцентиль недавних замеров),
+# запускается резервный запрос к модели из MODEL_FALLBACKS (или к той же)
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.05"))  # Не больше 5% запросов
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_DELAY = 1.0  # секунды
+HEDGE_DEFAULT_DELAY = 5.0  # Пока замеров мало
+HEDGE_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+HEDGE_BURST = 5  # Сколько резервных запросов можно запустить подряд
+
+# Очередь запросов к AI
+AI_MAX_CONCURRENT = int(os.getenv("AI_MAX_CONCURRENT", "20"))  # Одновременных запросов к OpenAI
+PRIORITY_HEAD_START = float(os.getenv("PRIORITY_HEAD_START", "10"))  # Фора Premium в очереди, секунды
+# Задания от хендлеров Telegram выполняют воркеры. Воркеров больше, чем AI_MAX_CONCURRENT,
+# чтобы приоритетная очередь видела ожидающие запросы обоих тарифов
+AI_WORKERS = int(os.getenv("AI_WORKERS", "40"))
+AI_QUEUE_SIZE = int(os.getenv("AI_QUEUE_SIZE", "500"))  # Заданий в очереди, дальше новые отклоняются
+
+# Где хранится очередь: memory — в процессе бота, sqlite — в БД, задания выполняют
+# отдельные процессы "python bot.py --worker N" (N от 0 до AI_WORKER_SHARDS - 1)
+AI_JOB_BACKEND = os.getenv("AI_JOB_BACKEND", "memory")
+AI_WORKER_SHARDS = int(os.getenv("AI_WORKER_SHARDS", "1"))  # Число процессов-воркеров
+AI_JOB_LEASE = 60.0  # Аренда задания, секунды; продлевается, пока воркер жив
+AI_JOB_HEARTBEAT = 15.0
+AI_JOB_MAX_ATTEMPTS = 3
+AI_JOB_RETRY_DELAY = 5.0
+AI_JOB_POLL_INTERVAL = 0.2
+AI_JOB_DELIVERY_BATCH = 50
+AI_JOB_STATS_INTERVAL = 10.0
+AI_JOB_RETENTION = 24 * 3600  # Сколько хранить доставленные задания, секунды
+
+# Контроль перегрузки (overload.py). Нагрузка — максимум из отношений сигналов к порогам:
+# ожидающих запросов, времени до первого токена OpenAI и задержки event loop.
+# Уровни: 1 — короче ответы, 2 — дешевая модель для бесплатных, 3 — без истории,
+# 4 — бесплатным "попробуйте позже"
+OVERLOAD_QUEUE_DEPTH = int(os.getenv("OVERLOAD_QUEUE_DEPTH", "50"))
+OVERLOAD_TTFT = float(os.getenv("OVERLOAD_TTFT", "5"))  # секунды
+OVERLOAD_LOOP_LAG = 0.2  # секунды
+OVERLOAD_THRESHOLDS = [1.0, 1.5, 2.0, 3.0]  # Нагрузка, с которой включается уровень 1, 2, 3, 4
+OVERLOAD_HYSTERESIS = 0.7  # Уровень снижается, когда нагрузка ниже порога * 0.7
+OVERLOAD_MIN_DWELL = 15.0  # Не снижать уровень чаще, секунды
+OVERLOAD_CHECK_INTERVAL = 0.5
+OVERLOAD_SIGNAL_TTL = 30.0  # Замеры OpenAI старше этого не учитываются
+OVERLOAD_MAX_TOKENS_FACTOR = 0.5
+OVERLOAD_FREE_MODEL = os.getenv("OVERLOAD_FREE_MODEL", "gpt-4.1-nano")  # Дешевле GPT_MODEL
+OVERLOAD_DB_POLL_INTERVAL = 2.0  # Как часто считать ожидающие задания в БД (AI_JOB_BACKEND=sqlite), секунды
+
+# Разбивка задержки по этапам (tracing.py): /latency и локальный эндпоинт метрик
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "15"))  # Медленные запросы пишутся в лог
+TRACE_EXEMPLARS = 10  # Сколько последних медленных запросов показывать в /latency
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — эндпоинт выключен
+
+# Объединение сообщений, отправленных подряд (включается пользователем через /merge)
+MERGE_WINDOW_MS = int(os.getenv("MERGE_WINDOW_MS", "1500"))  # Пауза, после которой пачка закрывается
+MERGE_MAX_WAIT_MS = int(os.getenv("MERGE_MAX_WAIT_MS", "6000"))  # Максимальное ожидание пачки
+MERGE_MAX_MESSAGES = 10
+
+# Что делать с новым сообщением, пока предыдущий запрос пользователя еще выполняется:
+# queue — ждать, reject — ответить уведомлением, cancel — отменить предыдущий запрос
+USER_REQUEST_POLICY = os.getenv("USER_REQUEST_POLICY", "queue")
+
 # Узбекские платежные системы
 CLICK_SERVICE_ID = os.getenv("CLICK_SERVICE_ID", "")
 PAYME_MERCHANT_ID = os.getenv("PAYME_MERCHANT_ID", "")
@@ -41,9 +184,71 @@ DURATIONS = {
 FREE_QUERIES_PER_DAY = int(os.getenv("FREE_QUERIES_PER_DAY", "5"))
 REFERRAL_BONUS = int(os.getenv("REFERRAL_BONUS", "10"))
 
+# Режим лимитов: queries — число запросов в день, tokens — дневной бюджет токенов
+QUOTA_MODE = os.getenv("QUOTA_MODE", "queries")
+FREE_TOKENS_PER_DAY = int(os.getenv("FREE_TOKENS_PER_DAY", "20000"))
+PREMIUM_TOKENS_PER_DAY = int(os.getenv("PREMIUM_TOKENS_PER_DAY", "500000"))
+TOKEN_QUOTA_COMPLETION_ESTIMATE = 500  # Резерв на ответ до получения фактического расхода
+TOKEN_QUOTA_HISTORY_ESTIMATE = 1000  # Резерв на историю, когда она в процессе-воркере (AI_JOB_BACKEND=sqlite)
+
+# История диалога: растет до HISTORY_MAX_MESSAGES, затем разом сжимается
+# до HISTORY_COMPACT_TO (редкие сжатия сохраняют кэш промптов OpenAI)
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "30"))
+HISTORY_COMPACT_TO = int(os.getenv("HISTORY_COMPACT_TO", "16"))
+
+# Одинаковые первые сообщения, пришедшие одновременно, получают ответ одного запроса к AI
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "1") == "1"
+
+# Готовые ответы на вопросы о боте (faq.py): отвечаем без AI и без списания лимита
+FAQ_ENABLED = os.getenv("FAQ_ENABLED", "1") == "1"
+FAQ_MAX_WORDS = 10  # Более длинные сообщения — задания для AI
+FAQ_MIN_SCORE = 0.9  # Похожесть на пример вопроса, если ключевые слова не совпали
+FAQ_TYPO_RATIO = 0.8  # Насколько слово может отличаться от ключевого (опечатки)
+
+# Долговременная память: прошлые пары вопрос-ответ хранятся в БД, подходящие
+# к новому вопросу (поиск BM25) добавляются в промпт вместо старой истории
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "1") == "1"
+MEMORY_TOP_K = 3
+MEMORY_MIN_SCORE = 2.0  # Более слабые совпадения в промпт не попадают
+MEMORY_SNIPPET_CHARS = 500  # Сколько символов вопроса и ответа сохранять
+MEMORY_MAX_SNIPPETS = 500  # На пользователя, старые удаляются
+MEMORY_MAX_USERS = 1000  # Индексов в памяти процесса
+
+# Кэш ответов на первые сообщения диалога
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # секунды
+RESPONSE_CACHE_MAX_MESSAGE_LENGTH = 200
+# Регулярные выражения: такие сообщения никогда не берутся из кэша
+RESPONSE_CACHE_EXCLUDE = [
+    r"\b(сегодня|сейчас|завтра|вчера|today|now)\b",
+    r"\b(курс|погода|новости|weather|news)\b",
+    r"\b(меня|мне|мой|моя|мое|моё|мои)\b",
+    r"\d{3,}",
+]
+
+# Поиск почти совпадающих первых сообщений (MinHash, без внешних API)
+NEAR_CACHE_ENABLED = os.getenv("NEAR_CACHE_ENABLED", "1") == "1"
+NEAR_CACHE_THRESHOLD = float(os.getenv("NEAR_CACHE_THRESHOLD", "0.8"))
+NEAR_CACHE_SHORT_THRESHOLD = 0.9  # Для коротких запросов
+NEAR_CACHE_SHORT_SHINGLES = 12
+NEAR_CACHE_PERMUTATIONS = 64
+NEAR_CACHE_BANDS = 16
+
 # Database
 DATABASE_PATH = "database.db"
 
+# Учет расхода токенов
+TOKEN_USAGE_BATCH_SIZE = 50  # Записей в одной пачке
+TOKEN_USAGE_FLUSH_INTERVAL = 10  # Сохранять не реже, чем раз в столько секунд
+
+# Цены моделей, $ за 1M токенов (input — промпт, cached — закэшированная часть промпта)
+MODEL_PRICES = {
+    "gpt-4o-mini": {"input": 0.15, "cached": 0.075, "output": 0.60},
+    "gpt-4o": {"input": 2.50, "cached": 1.25, "output": 10.00},
+    "gpt-4.1-nano": {"input": 0.10, "cached": 0.025, "output": 0.40},
+}
+
 # Bot texts
 TEXTS = {
     "welcome": """
@@ -76,6 +281,66 @@ TEXTS = {
 • Доступ к GPT-4
 
 👇 Выберите тариф или пригласите друга и получите +{referral_bonus} запросов!
+""",
+
+    "token_limit_reached": """
+⚠️ <b>Дневной лимит токенов исчерпан</b>
+
+Ваш бюджет на сегодня — {token_limit:,} токенов. Длинные тексты расходуют его быстрее.
+
+💎 <b>Получите Premium подписку:</b>
+• Увеличенный дневной бюджет
+• Приоритетная обработка
+• Доступ к GPT-4
+
+👇 Выберите тариф или пригласите друга и получите +{referral_bonus} запросов!
+""",
+
+    "overloaded": "⏳ Сейчас очень высокая нагрузка, бесплатные запросы временно приостановлены. Попробуйте через несколько минут — запрос не списан. Premium обслуживается без ограничений.",
+
+    "queue_full": "⏳ Сейчас очень много запросов. Попробуйте через минуту — запрос не списан.",
+
+    "job_failed": "❌ Не удалось обработать запрос. Попробуйте еще раз — запрос не списан.",
+
+    "queue_wait": "⏳ Много запросов, ваше сообщение в очереди (место: {position}). Отвечу чуть позже!",
+
+    "mode_translate": "🌐 <b>Режим перевода</b>\n\nПришлите текст — я переведу его (с русского и узбекского — на английский, с других языков — на русский). Нужен другой язык — укажите его в сообщении.\n\nВыключить: /translate",
+    "mode_code": "💻 <b>Режим программирования</b>\n\nПомогу написать, объяснить или исправить код.\n\nВыключить: /code",
+    "mode_write": "✍️ <b>Режим текстов</b>\n\nНапишу пост, статью, письмо или отредактирую ваш текст.\n\nВыключить: /write",
+    "mode_chat": "💬 <b>Режим общения</b>\n\nКороткие ответы для легкой беседы.\n\nВыключить: /chat",
+    "mode_auto": "🤖 Режим выключен. Отвечаю на любые вопросы.",
+
+    "faq_payment": """
+💳 <b>Как оплатить Premium</b>
+
+📱 Click или Payme — прямо в боте
+💳 Перевод на карту {card_bank} (Uzcard/Humo) — подписка включается после проверки платежа
+
+Выберите тариф 👇
+""",
+
+    "faq_limits": """
+📊 <b>Лимиты</b>
+
+🎁 Бесплатно: {free_queries} запросов в день, лимит обновляется каждые сутки.
+💎 Premium: безлимитные запросы.
+
+За каждого приглашенного друга — +{referral_bonus} запросов. Остаток на сегодня: /profile
+""",
+
+    "faq_limits_tokens": """
+📊 <b>Лимиты</b>
+
+🎁 Бесплатно: {free_tokens:,} токенов в день, бюджет обновляется каждые сутки.
+💎 Premium: {premium_tokens:,} токенов в день.
+
+Длинные тексты расходуют бюджет быстрее. За каждого приглашенного друга — +{referral_bonus} запросов. Остаток на сегодня: /profile
+""",
+
+    "faq_referral": """
+🎁 <b>Реферальная программа</b>
+
+Отправьте другу свою ссылку из /referral. Когда он запустит бота, вы получите <b>+{referral_bonus} запросов</b>.
 """,
 
     "subscription_info": """
@@ -143,5 +408,7 @@ TEXTS = {
 
 📈 Новых за сегодня: {new_today}
 📈 Новых за неделю: {new_week}
+
+🧠 Кэш промптов OpenAI сегодня: {prompt_cache_ratio:.0%}
 """
 }
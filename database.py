@@ -1,15 +1,31 @@
 """
 Модуль работы с базой данных
 """
+import asyncio
+import logging
+import time
 import aiosqlite
 from datetime import datetime, timedelta
 from typing import Optional
 import config
 
+logger = logging.getLogger(__name__)
+
+
+async def _add_column(db, table: str, column: str, definition: str):
+    """Добавить колонку в существующую таблицу, если ее еще нет"""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if column not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 
 async def init_db():
     """Инициализация базы данных"""
     async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        # WAL: воркеры в других процессах пишут, не блокируя чтение
+        await db.execute("PRAGMA journal_mode=WAL")
+        
         # Таблица пользователей
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -20,10 +36,16 @@ async def init_db():
                 referrer_id INTEGER,
                 total_queries INTEGER DEFAULT 0,
                 bonus_queries INTEGER DEFAULT 0,
-                is_banned INTEGER DEFAULT 0
+                is_banned INTEGER DEFAULT 0,
+                merge_messages INTEGER DEFAULT 0,
+                mode TEXT DEFAULT 'auto'
             )
         """)
         
+        # Колонки, добавленные после первого релиза
+        await _add_column(db, "users", "merge_messages", "INTEGER DEFAULT 0")
+        await _add_column(db, "users", "mode", "TEXT DEFAULT 'auto'")
+        
         # Таблица подписок
         await db.execute("""
             CREATE TABLE IF NOT EXISTS subscriptions (
@@ -45,10 +67,12 @@ async def init_db():
                 user_id INTEGER,
                 query_date DATE,
                 query_count INTEGER DEFAULT 0,
+                token_count INTEGER DEFAULT 0,
                 FOREIGN KEY (user_id) REFERENCES users(user_id),
                 UNIQUE(user_id, query_date)
             )
         """)
+        await _add_column(db, "usage", "token_count", "INTEGER DEFAULT 0")
         
         # Таблица платежей
         await db.execute("""
@@ -64,6 +88,69 @@ async def init_db():
             )
         """)
         
+        # Расход токенов по запросам к AI (компактно: без id, строки пишутся пачками)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS token_usage (
+                user_id INTEGER,
+                created_at TIMESTAMP,
+                model TEXT,
+                plan TEXT,
+                task TEXT,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                cached_tokens INTEGER,
+                latency_ms INTEGER
+            )
+        """)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_token_usage_created
+            ON token_usage(created_at)
+        """)
+        
+        # Очередь заданий AI для воркеров в отдельных процессах.
+        # visible_at (unix-время): когда задание можно взять; у выполняемого — конец аренды
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS ai_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT DEFAULT 'chat',
+                user_id INTEGER,
+                chat_id INTEGER,
+                text TEXT,
+                is_premium INTEGER DEFAULT 0,
+                use_bonus INTEGER DEFAULT 0,
+                reserved_tokens INTEGER DEFAULT 0,
+                mode TEXT DEFAULT 'auto',
+                status TEXT DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                worker TEXT,
+                visible_at REAL,
+                created_at REAL,
+                finished_at REAL,
+                success INTEGER,
+                response TEXT,
+                tokens INTEGER DEFAULT 0
+            )
+        """)
+        await _add_column(db, "ai_jobs", "mode", "TEXT DEFAULT 'auto'")
+        # Долговременная память: пары вопрос-ответ для поиска по прошлым разговорам
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS memory_snippets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                text TEXT
+            )
+        """)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_memory_snippets_user
+            ON memory_snippets(user_id, id)
+        """)
+        
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ai_jobs_status
+            ON ai_jobs(status, visible_at)
+        """)
+        
         await db.commit()
 
 
@@ -96,6 +183,26 @@ async def create_user(user_id: int, username: str, first_name: str, referrer_id:
         await db.commit()
 
 
+async def set_merge_messages(user_id: int, enabled: bool):
+    """Включить или выключить объединение сообщений"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        await db.execute(
+            "UPDATE users SET merge_messages = ? WHERE user_id = ?",
+            (int(enabled), user_id)
+        )
+        await db.commit()
+
+
+async def set_user_mode(user_id: int, mode: str):
+    """Сохранить режим работы пользователя (config.MODES или "auto")"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        await db.execute(
+            "UPDATE users SET mode = ? WHERE user_id = ?",
+            (mode, user_id)
+        )
+        await db.commit()
+
+
 async def get_today_usage(user_id: int) -> int:
     """Получить количество запросов за сегодня"""
     today = datetime.now().date()
@@ -108,16 +215,67 @@ async def get_today_usage(user_id: int) -> int:
             return row[0] if row else 0
 
 
-async def increment_usage(user_id: int):
-    """Увеличить счетчик использования"""
+async def get_today_tokens(user_id: int) -> int:
+    """Получить количество токенов, израсходованных за сегодня"""
+    today = datetime.now().date()
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with db.execute(
+            "SELECT token_count FROM usage WHERE user_id = ? AND query_date = ?",
+            (user_id, today)
+        ) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+
+async def reserve_tokens(user_id: int, tokens: int, limit: int) -> bool:
+    """
+    Зарезервировать токены из дневного бюджета.
+    Проверка и списание — один атомарный запрос: резерв проходит,
+    только если после него расход не превысит limit.
+    """
+    if tokens > limit:
+        return False
+    
+    today = datetime.now().date()
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        cursor = await db.execute("""
+            INSERT INTO usage (user_id, query_date, query_count, token_count)
+            VALUES (?, ?, 0, ?)
+            ON CONFLICT(user_id, query_date)
+            DO UPDATE SET token_count = token_count + excluded.token_count
+            WHERE token_count + excluded.token_count <= ?
+        """, (user_id, today, tokens, limit))
+        reserved = cursor.rowcount > 0
+        await db.commit()
+    return reserved
+
+
+async def release_tokens(user_id: int, tokens: int):
+    """Вернуть зарезервированные токены (запрос не выполнен)"""
+    today = datetime.now().date()
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        await db.execute("""
+            UPDATE usage SET token_count = MAX(token_count - ?, 0)
+            WHERE user_id = ? AND query_date = ?
+        """, (tokens, user_id, today))
+        await db.commit()
+
+
+async def increment_usage(user_id: int, tokens: int = 0):
+    """
+    Увеличить счетчик использования.
+    tokens — сколько добавить к дневному расходу токенов (может быть
+    отрицательным, если резерв оказался больше фактического расхода)
+    """
     today = datetime.now().date()
     async with aiosqlite.connect(config.DATABASE_PATH) as db:
         await db.execute("""
-            INSERT INTO usage (user_id, query_date, query_count)
-            VALUES (?, ?, 1)
+            INSERT INTO usage (user_id, query_date, query_count, token_count)
+            VALUES (?, ?, 1, ?)
             ON CONFLICT(user_id, query_date) 
-            DO UPDATE SET query_count = query_count + 1
-        """, (user_id, today))
+            DO UPDATE SET query_count = query_count + 1,
+                          token_count = MAX(token_count + ?, 0)
+        """, (user_id, today, max(tokens, 0), tokens))
         
         await db.execute("""
             UPDATE users SET total_queries = total_queries + 1
@@ -215,6 +373,7 @@ async def update_payment_status(payment_id: str, status: str):
 
 async def get_stats() -> dict:
     """Получить статистику для админа"""
+    await flush_token_usage()
     async with aiosqlite.connect(config.DATABASE_PATH) as db:
         # Всего пользователей
         async with db.execute("SELECT COUNT(*) FROM users") as cursor:
@@ -257,11 +416,331 @@ async def get_stats() -> dict:
         ) as cursor:
             new_week = (await cursor.fetchone())[0]
         
+        # Доля промпта, взятая из кэша OpenAI, за сегодня
+        async with db.execute(
+            "SELECT SUM(prompt_tokens), SUM(cached_tokens) FROM token_usage WHERE DATE(created_at) = ?",
+            (today,)
+        ) as cursor:
+            prompt_tokens, cached_tokens = await cursor.fetchone()
+            prompt_cache_ratio = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+        
         return {
             "total_users": total_users,
             "premium_users": premium_users,
             "today_queries": today_queries,
             "monthly_revenue": monthly_revenue,
             "new_today": new_today,
-            "new_week": new_week
+            "new_week": new_week,
+            "prompt_cache_ratio": prompt_cache_ratio
         }
+
+
+# ==================== РАСХОД ТОКЕНОВ ====================
+
+# Записи, ожидающие сохранения в token_usage
+_token_usage_buffer: list[tuple] = []
+
+
+async def record_token_usage(user_id: int, model: str, plan: str, task: str,
+                             prompt_tokens: int, completion_tokens: int,
+                             cached_tokens: int, latency_ms: int):
+    """Учесть расход токенов (пишется в БД пачками)"""
+    _token_usage_buffer.append((
+        user_id, datetime.now(), model, plan, task,
+        prompt_tokens, completion_tokens, cached_tokens, latency_ms
+    ))
+    if len(_token_usage_buffer) >= config.TOKEN_USAGE_BATCH_SIZE:
+        try:
+            await flush_token_usage()
+        except Exception as e:
+            logger.error(f"Failed to flush token usage: {e}")
+
+
+async def flush_token_usage():
+    """Сохранить накопленные записи о расходе токенов"""
+    if not _token_usage_buffer:
+        return
+    
+    rows = _token_usage_buffer[:]
+    _token_usage_buffer.clear()
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        await db.executemany("""
+            INSERT INTO token_usage (
+                user_id, created_at, model, plan, task,
+                prompt_tokens, completion_tokens, cached_tokens, latency_ms
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        await db.commit()
+
+
+async def token_usage_flusher():
+    """Фоновая периодическая запись расхода токенов"""
+    while True:
+        await asyncio.sleep(config.TOKEN_USAGE_FLUSH_INTERVAL)
+        try:
+            await flush_token_usage()
+        except Exception as e:
+            logger.error(f"Failed to flush token usage: {e}")
+
+
+def token_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    """Стоимость запроса в долларах по ценам MODEL_PRICES"""
+    prices = config.MODEL_PRICES.get(model)
+    if not prices:
+        return 0.0
+    uncached = prompt_tokens - cached_tokens
+    return (
+        uncached * prices["input"]
+        + cached_tokens * prices["cached"]
+        + completion_tokens * prices["output"]
+    ) / 1_000_000
+
+
+# Допустимые группировки для get_token_costs
+_COST_GROUPS = {
+    "user": "user_id",
+    "day": "DATE(created_at)",
+    "plan": "plan",
+    "task": "task",
+    "model": "model",
+}
+
+
+async def get_token_costs(group_by: str, days: int = 1, limit: int = 10) -> list[dict]:
+    """
+    Расход токенов и стоимость за последние days дней,
+    сгруппированные по user/day/plan/task/model, по убыванию стоимости
+    """
+    column = _COST_GROUPS[group_by]
+    since = datetime.now() - timedelta(days=days)
+    
+    await flush_token_usage()
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with db.execute(f"""
+            SELECT {column}, model, COUNT(*), SUM(prompt_tokens),
+                   SUM(cached_tokens), SUM(completion_tokens), AVG(latency_ms)
+            FROM token_usage
+            WHERE created_at > ?
+            GROUP BY {column}, model
+        """, (since,)) as cursor:
+            rows = await cursor.fetchall()
+    
+    groups: dict = {}
+    for key, model, requests, prompt, cached, completion, latency in rows:
+        group = groups.setdefault(key, {
+            group_by: key, "requests": 0, "prompt_tokens": 0, "cached_tokens": 0,
+            "completion_tokens": 0, "cost": 0.0, "_latency_total": 0.0
+        })
+        group["requests"] += requests
+        group["prompt_tokens"] += prompt
+        group["cached_tokens"] += cached
+        group["completion_tokens"] += completion
+        group["cost"] += token_cost(model, prompt, cached, completion)
+        group["_latency_total"] += latency * requests
+    
+    result = []
+    for group in groups.values():
+        group["avg_latency_ms"] = int(group.pop("_latency_total") / group["requests"])
+        result.append(group)
+    result.sort(key=lambda group: group["cost"], reverse=True)
+    return result[:limit]
+
+
+# ==================== ДОЛГОВРЕМЕННАЯ ПАМЯТЬ ====================
+
+async def add_memory_snippet(user_id: int, text: str) -> int:
+    """Сохранить фрагмент разговора, вернуть его id"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        cursor = await db.execute(
+            "INSERT INTO memory_snippets (user_id, text) VALUES (?, ?)",
+            (user_id, text)
+        )
+        await db.commit()
+        return cursor.lastrowid
+
+
+async def get_memory_snippets(user_id: int, limit: int) -> list[tuple[int, str]]:
+    """Последние limit фрагментов пользователя, от старых к новым"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with db.execute("""
+            SELECT id, text FROM memory_snippets
+            WHERE user_id = ? ORDER BY id DESC LIMIT ?
+        """, (user_id, limit)) as cursor:
+            rows = await cursor.fetchall()
+    return [(row[0], row[1]) for row in reversed(rows)]
+
+
+async def delete_memory_snippets(user_id: int, up_to_id: int = None):
+    """Удалить фрагменты пользователя (все или с id не больше up_to_id)"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        if up_to_id is None:
+            await db.execute("DELETE FROM memory_snippets WHERE user_id = ?", (user_id,))
+        else:
+            await db.execute(
+                "DELETE FROM memory_snippets WHERE user_id = ? AND id <= ?",
+                (user_id, up_to_id)
+            )
+        await db.commit()
+
+
+# ==================== ОЧЕРЕДЬ ЗАДАНИЙ AI ====================
+# Статусы: queued -> running -> done -> delivered.
+# Воркер арендует задание на AI_JOB_LEASE секунд и продлевает аренду, пока работает;
+# если воркер умер, задание снова становится видимым. Номер попытки (attempts)
+# защищает от записи результата воркером, чью аренду уже забрали.
+
+async def enqueue_ai_job(job: dict) -> int:
+    """Поставить задание в очередь, вернуть его id"""
+    now = time.time()
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        cursor = await db.execute("""
+            INSERT INTO ai_jobs (
+                kind, user_id, chat_id, text, is_premium, use_bonus,
+                reserved_tokens, mode, visible_at, created_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            job.get("kind", "chat"), job["user_id"], job["chat_id"], job.get("text"),
+            int(job.get("is_premium", False)), int(job.get("use_bonus", False)),
+            job.get("reserved_tokens", 0), job.get("mode", "auto"), now, now
+        ))
+        await db.commit()
+        return cursor.lastrowid
+
+
+async def count_pending_ai_jobs() -> int:
+    """Заданий в очереди и в работе"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM ai_jobs WHERE status IN ('queued', 'running')"
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def count_queued_ai_jobs() -> int:
+    """Заданий, еще не взятых воркером"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM ai_jobs WHERE status = 'queued'"
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def claim_ai_jobs(worker: str, limit: int, shard: int, shards: int) -> list[dict]:
+    """
+    Арендовать до limit видимых заданий своей доли пользователей (user_id % shards == shard).
+    Задания, исчерпавшие попытки, завершаются с ошибкой.
+    """
+    now = time.time()
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        await db.execute("""
+            UPDATE ai_jobs SET status = 'done', success = 0, response = ?, finished_at = ?
+            WHERE status IN ('queued', 'running') AND visible_at <= ? AND attempts >= ?
+        """, (config.TEXTS["job_failed"], now, now, config.AI_JOB_MAX_ATTEMPTS))
+        async with db.execute("""
+            UPDATE ai_jobs
+            SET status = 'running', worker = ?, attempts = attempts + 1, visible_at = ?
+            WHERE id IN (
+                SELECT id FROM ai_jobs
+                WHERE status IN ('queued', 'running') AND visible_at <= ? AND user_id % ? = ?
+                ORDER BY id LIMIT ?
+            )
+            RETURNING *
+        """, (worker, now + config.AI_JOB_LEASE, now, shards, shard, limit)) as cursor:
+            rows = [dict(row) for row in await cursor.fetchall()]
+        await db.commit()
+    return sorted(rows, key=lambda row: row["id"])
+
+
+async def extend_ai_job_leases(worker: str, job_ids: list[int]):
+    """Продлить аренду заданий, которые воркер еще выполняет"""
+    if not job_ids:
+        return
+    placeholders = ",".join("?" * len(job_ids))
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        await db.execute(f"""
+            UPDATE ai_jobs SET visible_at = ?
+            WHERE worker = ? AND status = 'running' AND id IN ({placeholders})
+        """, (time.time() + config.AI_JOB_LEASE, worker, *job_ids))
+        await db.commit()
+
+
+async def complete_ai_job(job: dict, worker: str, success: bool,
+                          response: Optional[str], tokens: int) -> bool:
+    """Записать результат; False, если аренду уже забрал другой воркер"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        cursor = await db.execute("""
+            UPDATE ai_jobs
+            SET status = 'done', success = ?, response = ?, tokens = ?, finished_at = ?
+            WHERE id = ? AND worker = ? AND attempts = ? AND status = 'running'
+        """, (int(success), response, tokens, time.time(), job["id"], worker, job["attempts"]))
+        await db.commit()
+        return cursor.rowcount > 0
+
+
+async def retry_ai_job(job: dict, worker: str, delay: float):
+    """Вернуть задание в очередь после сбоя воркера"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        await db.execute("""
+            UPDATE ai_jobs SET status = 'queued', visible_at = ?
+            WHERE id = ? AND worker = ? AND attempts = ? AND status = 'running'
+        """, (time.time() + delay, job["id"], worker, job["attempts"]))
+        await db.commit()
+
+
+async def cancel_queued_ai_jobs(user_id: int) -> int:
+    """
+    Завершить без ответа еще не взятые задания пользователя (/clear):
+    доставка вернет их резерв и ничего не отправит
+    """
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        cursor = await db.execute("""
+            UPDATE ai_jobs SET status = 'done', success = 0, response = NULL, finished_at = ?
+            WHERE user_id = ? AND kind = 'chat' AND status = 'queued'
+        """, (time.time(), user_id))
+        await db.commit()
+        return cursor.rowcount
+
+
+async def take_finished_ai_jobs(limit: int) -> list[dict]:
+    """Забрать выполненные задания для доставки (каждое выдается один раз)"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute("""
+            UPDATE ai_jobs SET status = 'delivered'
+            WHERE id IN (
+                SELECT id FROM ai_jobs WHERE status = 'done' ORDER BY id LIMIT ?
+            )
+            RETURNING *
+        """, (limit,)) as cursor:
+            rows = [dict(row) for row in await cursor.fetchall()]
+        await db.commit()
+    return sorted(rows, key=lambda row: row["id"])
+
+
+async def delete_delivered_ai_jobs(older_than: float):
+    """Удалить доставленные задания старше older_than секунд"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        await db.execute(
+            "DELETE FROM ai_jobs WHERE status = 'delivered' AND finished_at < ?",
+            (time.time() - older_than,)
+        )
+        await db.commit()
+
+
+async def get_ai_job_stats() -> dict:
+    """Задания по статусам и возраст самого старого ожидающего"""
+    async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with db.execute(
+            "SELECT status, COUNT(*), MIN(created_at) FROM ai_jobs GROUP BY status"
+        ) as cursor:
+            rows = await cursor.fetchall()
+    
+    result = {status: 0 for status in ("queued", "running", "done", "delivered")}
+    oldest_queued = None
+    for status, count, created_at in rows:
+        result[status] = count
+        if status == "queued":
+            oldest_queued = created_at
+    result["oldest_queued_s"] = time.time() - oldest_queued if oldest_queued else 0.0
+    return result
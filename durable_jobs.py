@@ -0,0 +1,166 @@
+"""
+Очередь заданий AI в SQLite: воркеры в отдельных процессах, доставка в процессе Telegram
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+
+import config
+import database as db
+from job_queue import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+async def submit(job: dict) -> int:
+    """Поставить задание; вернуть его место среди ждущих воркера (0 — начнется сразу)"""
+    pending = await db.count_pending_ai_jobs()
+    if pending >= config.AI_QUEUE_SIZE:
+        raise QueueFullError()
+    await db.enqueue_ai_job(job)
+    capacity = config.AI_WORKERS * config.AI_WORKER_SHARDS
+    return max(pending + 1 - capacity, 0)
+
+
+class DurableWorker:
+    """
+    Воркер-процесс: арендует задания своей доли пользователей, продлевает аренду,
+    пока задание выполняется, и записывает результат. handler(job) возвращает
+    (success, response, tokens). Доля (shard) закрепляет пользователя за одним
+    процессом, потому что история диалога хранится в памяти процесса.
+    """
+
+    def __init__(self, handler, shard: int, shards: int, concurrency: int):
+        if not 0 <= shard < shards:
+            raise ValueError(f"Worker shard must be in [0, {shards})")
+        self.handler = handler
+        self.shard = shard
+        self.shards = shards
+        self.concurrency = concurrency
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._running: dict[int, asyncio.Task] = {}
+        self._slot_freed = asyncio.Event()
+        self.claimed = 0
+        self.completed = 0
+        self.retried = 0
+        self.lost_leases = 0
+
+    async def run(self):
+        """Забирать задания, пока процесс не остановят"""
+        logger.info(f"AI worker {self.worker_id} serving shard {self.shard}/{self.shards}")
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while True:
+                free = self.concurrency - len(self._running)
+                jobs = []
+                if free > 0:
+                    try:
+                        jobs = await db.claim_ai_jobs(self.worker_id, free, self.shard, self.shards)
+                    except Exception as e:
+                        logger.error(f"Failed to claim AI jobs: {e}")
+                for job in jobs:
+                    self.claimed += 1
+                    self._running[job["id"]] = asyncio.create_task(self._execute(job))
+                if not jobs:
+                    # Ждем освобождения слота или следующего опроса очереди
+                    self._slot_freed.clear()
+                    try:
+                        await asyncio.wait_for(self._slot_freed.wait(), config.AI_JOB_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            heartbeat.cancel()
+            for task in self._running.values():
+                task.cancel()
+            # Незавершенные задания вернутся в очередь по истечении аренды
+            await asyncio.gather(heartbeat, *self._running.values(), return_exceptions=True)
+
+    async def _execute(self, job: dict):
+        try:
+            task = asyncio.create_task(self.handler(job))
+            await asyncio.wait({task})
+            if task.cancelled():
+                # Запрос отменен (политика cancel): ответа нет, резерв вернется при доставке
+                result = (False, None, 0)
+            elif task.exception() is not None:
+                logger.error(f"AI job {job['id']} failed", exc_info=task.exception())
+                self.retried += 1
+                await db.retry_ai_job(job, self.worker_id, config.AI_JOB_RETRY_DELAY)
+                return
+            else:
+                result = task.result()
+
+            if await db.complete_ai_job(job, self.worker_id, *result):
+                self.completed += 1
+            else:
+                self.lost_leases += 1
+                logger.warning(f"AI job {job['id']} lease was taken over, result dropped")
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        except Exception as e:
+            logger.error(f"Failed to store AI job {job['id']} result: {e}")
+        finally:
+            self._running.pop(job["id"], None)
+            self._slot_freed.set()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(config.AI_JOB_HEARTBEAT)
+            try:
+                await db.extend_ai_job_leases(self.worker_id, list(self._running))
+            except Exception as e:
+                logger.error(f"Failed to extend AI job leases: {e}")
+
+    def stats(self) -> dict:
+        """Задания этого процесса"""
+        return {
+            "shard": f"{self.shard}/{self.shards}",
+            "running": len(self._running),
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "retried": self.retried,
+            "lost_leases": self.lost_leases,
+        }
+
+
+class Deliverer:
+    """Процесс Telegram: забирает выполненные задания и отправляет ответы"""
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.delivered = 0
+        self._queue_stats: dict = {}
+        self._stats_at = 0.0
+
+    async def run(self):
+        """Доставлять результаты, пока процесс не остановят"""
+        while True:
+            try:
+                jobs = await db.take_finished_ai_jobs(config.AI_JOB_DELIVERY_BATCH)
+            except Exception as e:
+                logger.error(f"Failed to take finished AI jobs: {e}")
+                jobs = []
+            for job in jobs:
+                try:
+                    await self.deliver(job)
+                    self.delivered += 1
+                except Exception as e:
+                    logger.error(f"Failed to deliver AI job {job['id']}: {e}")
+
+            if time.monotonic() - self._stats_at > config.AI_JOB_STATS_INTERVAL:
+                self._stats_at = time.monotonic()
+                try:
+                    self._queue_stats = await db.get_ai_job_stats()
+                    await db.delete_delivered_ai_jobs(config.AI_JOB_RETENTION)
+                except Exception as e:
+                    logger.error(f"Failed to refresh AI job stats: {e}")
+
+            if not jobs:
+                await asyncio.sleep(config.AI_JOB_POLL_INTERVAL)
+
+    def stats(self) -> dict:
+        """Состояние очереди в БД (обновляется раз в AI_JOB_STATS_INTERVAL)"""
+        return dict(self._queue_stats, delivered=self.delivered)
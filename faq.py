@@ -0,0 +1,159 @@
+"""
+Готовые ответы на вопросы о самом боте (цены, оплата, лимиты, рефералы) без AI
+"""
+from difflib import SequenceMatcher
+from typing import Optional
+
+import config
+import metrics
+from long_memory import tokenize
+from response_cache import normalize_text
+
+# Слова, по которым видно, что вопрос о самом боте, а не о чужом сервисе
+BOT_WORDS = ["бот", "бота", "боте", "ботом", "neuralbot", "вас", "ваш", "ваша", "ваши", "вашего", "вашу", "вашей"]
+PREMIUM_WORDS = ["премиум", "premium"]
+
+# Сообщение с такого слова — задание для AI ("переведи: сколько стоит подписка")
+TASK_VERBS = [
+    "переведи", "напиши", "составь", "придумай", "объясни", "исправь", "перепиши",
+    "сделай", "создай", "сочини", "перескажи", "translate", "write",
+]
+
+
+def build_entries() -> list[dict]:
+    """
+    Вопросы и ответы из текущих TEXTS и PRICES. groups — группы слов:
+    вопрос подходит, если в нем есть слово из каждой группы; последняя группа
+    каждого ответа требует признак вопроса о боте (BOT_WORDS и т.п.).
+    keyboard — клавиатура, которую бот прикладывает к ответу.
+    """
+    if config.QUOTA_MODE == "tokens":
+        limits = config.TEXTS["faq_limits_tokens"].format(
+            free_tokens=config.FREE_TOKENS_PER_DAY,
+            premium_tokens=config.PREMIUM_TOKENS_PER_DAY,
+            referral_bonus=config.REFERRAL_BONUS,
+        )
+    else:
+        limits = config.TEXTS["faq_limits"].format(
+            free_queries=config.FREE_QUERIES_PER_DAY,
+            referral_bonus=config.REFERRAL_BONUS,
+        )
+
+    return [
+        {
+            "name": "prices",
+            "groups": [
+                ["сколько", "цена", "цены", "стоит", "стоимость", "тариф", "тарифы", "прайс"],
+                PREMIUM_WORDS + BOT_WORDS,
+            ],
+            "questions": ["сколько стоит премиум", "какие цены на подписку", "тарифы подписки", "цены"],
+            "answer": config.TEXTS["subscription_info"].format(
+                price_week=config.PRICES["week"],
+                price_month=config.PRICES["month"],
+                price_year=config.PRICES["year"],
+            ),
+            "keyboard": "subscription",
+        },
+        {
+            "name": "payment",
+            "groups": [
+                ["оплатить", "оплата", "оплаты", "оплачивать", "заплатить", "купить"],
+                PREMIUM_WORDS + BOT_WORDS,
+            ],
+            "questions": ["как оплатить подписку", "способы оплаты", "как оплатить"],
+            "answer": config.TEXTS["faq_payment"].format(card_bank=config.CARD_BANK),
+            "keyboard": "subscription",
+        },
+        {
+            "name": "limits",
+            "groups": [
+                ["лимит", "лимиты", "сколько", "осталось", "почему"],
+                ["запросов", "запросы", "запрос", "токенов", "сообщений"],
+                ["день", "сутки", "сегодня", "бесплатно", "бесплатных", "закончились", "кончились", "лимит"],
+                # "Осталось" и "закончились" — о лимите самого пользователя
+                BOT_WORDS + ["осталось", "закончились", "кончились"],
+            ],
+            "questions": ["сколько бесплатных запросов в день", "какой лимит запросов", "почему закончились запросы"],
+            "answer": limits,
+            "keyboard": "limit",
+        },
+        {
+            "name": "referral",
+            "groups": [
+                ["реферальная", "реферальную", "реферал", "рефералы", "пригласить", "пригласи", "приглашение"],
+                ["друга", "друзей", "ссылка", "ссылку", "бонус", "бонусы", "программа"],
+                BOT_WORDS + ["реферальная", "реферальную", "реферал", "рефералы"],
+            ],
+            "questions": ["как пригласить друга", "как работает реферальная программа", "что дают за друга"],
+            "answer": config.TEXTS["faq_referral"].format(referral_bonus=config.REFERRAL_BONUS),
+            "keyboard": None,
+        },
+    ]
+
+
+class FAQIndex:
+    """
+    Сопоставление сообщения с готовыми ответами: по ключевым словам
+    (с допуском опечаток) и по похожести на примеры вопросов.
+    Длинные сообщения и сообщения с глагола-задания ("переведи", "напиши")
+    — это задания для AI, их не проверяем.
+    """
+
+    def __init__(self, entries: list[dict]):
+        self.entries = entries
+        for entry in entries:
+            entry["stems"] = [set(tokenize(" ".join(group))) for group in entry["groups"]]
+            entry["normalized"] = [normalize_text(question) for question in entry["questions"]]
+        self.task_verbs = set(tokenize(" ".join(TASK_VERBS)))
+        self.checked = 0
+        self.matched: dict[str, int] = {}
+
+    @staticmethod
+    def _has_word(stems: set, words: list[str]) -> bool:
+        for word in words:
+            if word in stems:
+                return True
+            # Опечатки: длинные слова сравниваем нестрого
+            if len(word) >= 4 and any(
+                SequenceMatcher(None, word, stem).ratio() >= config.FAQ_TYPO_RATIO for stem in stems
+            ):
+                return True
+        return False
+
+    def _score(self, entry: dict, words: list[str], normalized: str) -> float:
+        if all(self._has_word(stems, words) for stems in entry["stems"]):
+            return 1.0
+        return max(SequenceMatcher(None, normalized, question).ratio() for question in entry["normalized"])
+
+    def match(self, text: str) -> Optional[dict]:
+        """Готовый ответ на сообщение или None"""
+        self.checked += 1
+        words = tokenize(text)
+        if not words or len(text.split()) > config.FAQ_MAX_WORDS or words[0] in self.task_verbs:
+            return None
+
+        normalized = normalize_text(text)
+        score, best = max(
+            ((self._score(entry, words, normalized), entry) for entry in self.entries),
+            key=lambda item: item[0]
+        )
+        if score < config.FAQ_MIN_SCORE:
+            return None
+        self.matched[best["name"]] = self.matched.get(best["name"], 0) + 1
+        return best
+
+    def stats(self) -> dict:
+        """Доля сообщений, на которые ответили без AI"""
+        matched = sum(self.matched.values())
+        result = {
+            "checked": self.checked,
+            "matched": matched,
+            "match_ratio": matched / self.checked if self.checked else 0.0,
+        }
+        for name, count in sorted(self.matched.items()):
+            result[f"matched_{name}"] = count
+        return result
+
+
+faq_index = FAQIndex(build_entries())
+metrics.register("faq", faq_index.stats)
@@ -0,0 +1,84 @@
+"""
+Хеджирование медленных запросов: политика дедлайна первого токена и бюджет
+"""
+from collections import deque
+
+import config
+import metrics
+
+
+class HedgePolicy:
+    """
+    Дедлайн первого токена берется из перцентиля недавних замеров по модели.
+    Бюджет: каждый запрос добавляет max_ratio "кредита", резервный запрос
+    тратит единицу — так доля хеджированных запросов не превышает max_ratio.
+    """
+
+    def __init__(self, max_ratio: float, percentile: float, min_delay: float, default_delay: float):
+        self.max_ratio = max_ratio
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self._ttft: dict[str, deque] = {}
+        self._credit = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.backup_wins = 0
+        self.loser_tokens = 0
+
+    def observe_ttft(self, model: str, seconds: float):
+        """Учесть время до первого токена"""
+        samples = self._ttft.get(model)
+        if samples is None:
+            samples = self._ttft[model] = deque(maxlen=config.HEDGE_SAMPLES)
+        samples.append(seconds)
+
+    def deadline(self, model: str) -> float:
+        """Сколько ждать первого токена, прежде чем запускать резервный запрос"""
+        samples = self._ttft.get(model)
+        if not samples or len(samples) < config.HEDGE_MIN_SAMPLES:
+            return self.default_delay
+        ordered = sorted(samples)
+        value = ordered[int(self.percentile * (len(ordered) - 1))]
+        return max(value, self.min_delay)
+
+    def track_request(self):
+        """Учесть запрос в бюджете"""
+        self.requests += 1
+        self._credit = min(self._credit + self.max_ratio, config.HEDGE_BURST)
+
+    def allow(self) -> bool:
+        """Разрешить резервный запрос, если бюджет не исчерпан"""
+        if self._credit < 1:
+            return False
+        self._credit -= 1
+        self.hedges += 1
+        return True
+
+    def record_winner(self, backup: bool, loser_tokens: int = 0):
+        """Учесть, какой из запросов ответил первым, и расход отмененного"""
+        if backup:
+            self.backup_wins += 1
+        self.loser_tokens += loser_tokens
+
+    def stats(self) -> dict:
+        """Доля хеджированных запросов и текущие дедлайны"""
+        result = {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_ratio": self.hedges / self.requests if self.requests else 0.0,
+            "backup_wins": self.backup_wins,
+            "loser_tokens": self.loser_tokens,
+        }
+        for model in self._ttft:
+            result[f"deadline_{model}_s"] = self.deadline(model)
+        return result
+
+
+hedge_policy = HedgePolicy(
+    config.HEDGE_MAX_RATIO,
+    config.HEDGE_PERCENTILE,
+    config.HEDGE_MIN_DELAY,
+    config.HEDGE_DEFAULT_DELAY,
+)
+metrics.register("hedging", hedge_policy.stats)
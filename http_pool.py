@@ -0,0 +1,126 @@
+"""
+Общий пул HTTP-соединений для клиента OpenAI
+"""
+import asyncio
+import logging
+
+import httpx
+from openai import DefaultAsyncHttpxClient
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """Тело ответа, которое сообщает пулу о своем закрытии"""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._on_close()
+
+
+class PoolTransport(httpx.AsyncHTTPTransport):
+    """Транспорт httpx со счетчиками занятости пула"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.http2 = kwargs.get("http2", False)
+        self.max_connections = kwargs["limits"].max_connections
+        # Запросы от отправки до закрытия тела ответа (потоковые ответы держат соединение)
+        self.in_flight = 0
+        self.requests = 0
+
+    def _release(self):
+        self.in_flight -= 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.requests += 1
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self._release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_TrackedStream(response.stream, self._release),
+            extensions=response.extensions,
+        )
+
+    def stats(self) -> dict:
+        """Открытые соединения и запросы, ждущие свободного соединения"""
+        connections = self._pool.connections
+        busy = sum(1 for connection in connections if not connection.is_idle())
+        result = {
+            "http2": self.http2,
+            "open_connections": len(connections),
+            "busy_connections": busy,
+            "max_connections": self.max_connections,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+        }
+        # В HTTP/1.1 одно соединение — один запрос, остальные ждут в пуле
+        if not self.http2:
+            result["waiting_acquisitions"] = max(self.in_flight - busy, 0)
+        return result
+
+
+def build_http_client() -> httpx.AsyncClient:
+    """HTTP-клиент с настроенными лимитами пула, keep-alive и таймаутами"""
+    http2 = config.OPENAI_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("OPENAI_HTTP2 is enabled but the h2 package is not installed, using HTTP/1.1")
+        http2 = False
+
+    transport = PoolTransport(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=config.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=config.OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=config.OPENAI_KEEPALIVE_EXPIRY,
+        ),
+    )
+    metrics.register("openai_http_pool", transport.stats)
+
+    return DefaultAsyncHttpxClient(
+        transport=transport,
+        timeout=httpx.Timeout(
+            connect=config.OPENAI_CONNECT_TIMEOUT,
+            read=config.OPENAI_READ_TIMEOUT,
+            write=config.OPENAI_CONNECT_TIMEOUT,
+            pool=config.OPENAI_POOL_TIMEOUT,
+        ),
+    )
+
+
+async def warm_up(client, connections: int):
+    """Заранее открыть соединения (DNS, TCP, TLS), чтобы первые запросы не ждали"""
+    async def ping():
+        try:
+            await client.models.retrieve(config.GPT_MODEL)
+        except Exception as e:
+            # Соединение открыто, даже если сам запрос неуспешен
+            logger.debug(f"Warm-up request failed: {e}")
+
+    await asyncio.gather(*[ping() for _ in range(connections)])
@@ -0,0 +1,162 @@
+"""
+Очередь заданий к AI и пул обработчиков: хендлер Telegram только ставит задание
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Очередь заданий заполнена"""
+
+
+class AIJobQueue:
+    """
+    Ограниченная очередь заданий и пул воркеров. Задание — словарь,
+    который обрабатывает функция handler(job); каждое задание выполняется
+    в своей задаче, чтобы его отмена (политика cancel) не останавливала воркер.
+    При per_user у пользователя в работе не больше одного задания, остальные
+    ждут в его личной очереди и не занимают воркеры.
+    """
+
+    def __init__(self, max_size: int, workers: int, per_user: bool = False):
+        self.max_size = max_size
+        self.workers = workers
+        self.per_user = per_user
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # user_id -> задания, ждущие окончания текущего задания пользователя
+        self._backlog: dict[int, deque] = {}
+        self._backlogged = 0
+        self._workers: list[asyncio.Task] = []
+        self._handler = None
+        self.busy = 0
+        self.submitted = 0
+        self.started = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    @property
+    def depth(self) -> int:
+        """Заданий, ждущих воркера"""
+        return self._queue.qsize() + self._backlogged
+
+    def start(self, handler):
+        """Запустить воркеры"""
+        self._handler = handler
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"ai-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def stop(self) -> list[dict]:
+        """Остановить воркеры; вернуть задания, которые так и не начали выполняться"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        left = []
+        while not self._queue.empty():
+            left.append(self._queue.get_nowait())
+        for backlog in self._backlog.values():
+            left.extend(backlog)
+        self._backlog.clear()
+        self._backlogged = 0
+        return left
+
+    def submit(self, job: dict) -> int:
+        """Поставить задание; вернуть его место среди ждущих воркера (0 — начнется сразу)"""
+        if self.depth >= self.max_size:
+            self.rejected += 1
+            raise QueueFullError()
+        job["enqueued_at"] = time.monotonic()
+        self.submitted += 1
+
+        if self.per_user:
+            backlog = self._backlog.get(job["user_id"])
+            if backlog is not None:
+                # Предыдущее задание пользователя еще в очереди или выполняется
+                backlog.append(job)
+                self._backlogged += 1
+                return len(backlog)
+            self._backlog[job["user_id"]] = deque()
+
+        self._queue.put_nowait(job)
+        return max(self._queue.qsize() - (self.workers - self.busy), 0)
+
+    def _release_user(self, user_id: int):
+        """Задание пользователя завершено: передать воркерам следующее"""
+        backlog = self._backlog.get(user_id)
+        if backlog is None:
+            return
+        if backlog:
+            self._backlogged -= 1
+            self._queue.put_nowait(backlog.popleft())
+        else:
+            del self._backlog[user_id]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            started = time.monotonic()
+            waited = started - job["enqueued_at"]
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.started += 1
+            self.busy += 1
+
+            task = asyncio.create_task(self._handler(job))
+            try:
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            finally:
+                self.busy -= 1
+                self.run_total += time.monotonic() - started
+                self._queue.task_done()
+                if self.per_user:
+                    self._release_user(job["user_id"])
+
+            if task.cancelled():
+                self.cancelled += 1
+            elif task.exception() is not None:
+                self.failed += 1
+                logger.error("AI job failed", exc_info=task.exception())
+            else:
+                self.completed += 1
+
+    def stats(self) -> dict:
+        """Глубина очереди, загрузка воркеров и задержки"""
+        finished = self.completed + self.failed + self.cancelled
+        return {
+            "depth": self.depth,
+            "backlogged": self._backlogged,
+            "max_size": self.max_size,
+            "workers": self.workers,
+            "busy_workers": self.busy,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "avg_wait_s": self.wait_total / self.started if self.started else 0.0,
+            "max_wait_s": self.wait_max,
+            "avg_run_s": self.run_total / finished if finished else 0.0,
+        }
+
+
+# При политике queue задания пользователя все равно выполнялись бы по очереди
+ai_jobs = AIJobQueue(config.AI_QUEUE_SIZE, config.AI_WORKERS, per_user=config.USER_REQUEST_POLICY == "queue")
+metrics.register("ai_jobs", ai_jobs.stats)
@@ -89,6 +89,8 @@ def get_admin_keyboard() -> InlineKeyboardMarkup:
     """Админ клавиатура"""
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin:stats")],
+        [InlineKeyboardButton(text="💰 Расходы на AI", callback_data="admin:costs")],
+        [InlineKeyboardButton(text="⚡ Производительность", callback_data="admin:perf")],
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin:broadcast")],
         [InlineKeyboardButton(text="👤 Найти пользователя", callback_data="admin:find_user")]
     ])
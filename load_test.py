@@ -0,0 +1,83 @@
+"""
+Нагрузочный тест ai_service без затрат на OpenAI
+
+Сначала запустите заглушку:
+    python mock_openai.py --port 8001
+Затем:
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=mock python load_test.py --users 200 --messages 3
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import config
+
+# Тест пишет расход токенов в отдельную базу
+config.DATABASE_PATH = "load_test.db"
+
+import database as db
+import metrics
+from ai_service import get_ai_response
+
+QUESTIONS = [
+    "привет",
+    "что ты умеешь",
+    "переведи на английский: доброе утро",
+    "напиши функцию на python для сортировки списка",
+    "расскажи коротко про историю Самарканда",
+    "придумай 5 идей для поста в Telegram",
+]
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[int(p * (len(ordered) - 1))]
+
+
+async def simulate_user(user_id: int, messages: int, premium_share: float, latencies: dict):
+    is_premium = random.random() < premium_share
+    tier = "premium" if is_premium else "free"
+    for _ in range(messages):
+        started = time.monotonic()
+        success, _, _ = await get_ai_response(user_id, random.choice(QUESTIONS), is_premium=is_premium)
+        latencies[tier].append(time.monotonic() - started)
+        if not success:
+            latencies["failed"] += 1
+        await asyncio.sleep(random.uniform(0, 1))
+
+
+async def main(args):
+    if not config.OPENAI_BASE_URL:
+        raise SystemExit("Укажите OPENAI_BASE_URL заглушки, чтобы не тратить деньги")
+
+    await db.init_db()
+    latencies = {"premium": [], "free": [], "failed": 0}
+    started = time.monotonic()
+    await asyncio.gather(*[
+        simulate_user(user_id, args.messages, args.premium_share, latencies)
+        for user_id in range(1, args.users + 1)
+    ])
+    elapsed = time.monotonic() - started
+    await db.flush_token_usage()
+
+    total = len(latencies["premium"]) + len(latencies["free"])
+    print(f"Запросов: {total} за {elapsed:.1f} с ({total / elapsed:.1f} rps), ошибок: {latencies['failed']}")
+    for tier in ("premium", "free"):
+        values = latencies[tier]
+        print(
+            f"{tier}: n={len(values)} p50={percentile(values, 0.5):.2f}s "
+            f"p95={percentile(values, 0.95):.2f}s p99={percentile(values, 0.99):.2f}s"
+        )
+    print(json.dumps(metrics.collect(), ensure_ascii=False, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for ai_service")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=3)
+    parser.add_argument("--premium-share", type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,166 @@
+"""
+Долговременная память диалогов: прошлые реплики и поиск по ним (BM25)
+"""
+import math
+import re
+import time
+from collections import OrderedDict
+
+import config
+import database as db
+import metrics
+
+_WORD_RE = re.compile(r"\w+")
+# Грубый стемминг: у русских словоформ обычно совпадает начало слова
+_STEM_LENGTH = 6
+
+K1 = 1.5
+B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """Слова текста, приведенные к общему началу"""
+    return [
+        word[:_STEM_LENGTH]
+        for word in _WORD_RE.findall(text.lower())
+        if len(word) > 2 or word.isdigit()
+    ]
+
+
+class BM25Index:
+    """Инвертированный индекс с добавлением и удалением документов по одному"""
+
+    def __init__(self):
+        self.docs: OrderedDict[int, str] = OrderedDict()
+        self._lengths: dict[int, int] = {}
+        self._postings: dict[str, dict[int, int]] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def add(self, doc_id: int, text: str):
+        terms = tokenize(text)
+        self.docs[doc_id] = text
+        self._lengths[doc_id] = len(terms)
+        self._total_length += len(terms)
+        for term in terms:
+            postings = self._postings.setdefault(term, {})
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    def remove_oldest(self) -> int:
+        doc_id, text = self.docs.popitem(last=False)
+        self._total_length -= self._lengths.pop(doc_id)
+        for term in set(tokenize(text)):
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+        return doc_id
+
+    def search(self, query: str, k: int, exclude_recent: int = 0) -> list[tuple[float, str]]:
+        """Лучшие k документов (оценка, текст); последние exclude_recent документов пропускаются"""
+        count = len(self.docs)
+        if not count:
+            return []
+        excluded = set(list(self.docs)[count - exclude_recent:]) if exclude_recent else set()
+        average_length = self._total_length / count or 1.0
+
+        scores: dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                if doc_id in excluded:
+                    continue
+                norm = K1 * (1 - B + B * self._lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (K1 + 1) / (frequency + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(score, self.docs[doc_id]) for doc_id, score in best]
+
+
+class LongTermMemory:
+    """
+    Память по пользователям: каждая пара вопрос-ответ сохраняется в БД
+    и добавляется в индекс. Индекс пользователя строится из БД при первом
+    обращении; в памяти держатся индексы max_users последних пользователей.
+    """
+
+    def __init__(self, max_snippets: int, max_users: int):
+        self.max_snippets = max_snippets
+        self.max_users = max_users
+        self._indexes: OrderedDict[int, BM25Index] = OrderedDict()
+        self.remembered = 0
+        self.searches = 0
+        self.hits = 0
+        self.search_time = 0.0
+
+    async def _index(self, user_id: int) -> BM25Index:
+        index = self._indexes.get(user_id)
+        if index is not None:
+            self._indexes.move_to_end(user_id)
+            return index
+
+        index = BM25Index()
+        for doc_id, text in await db.get_memory_snippets(user_id, self.max_snippets):
+            index.add(doc_id, text)
+        self._indexes[user_id] = index
+        if len(self._indexes) > self.max_users:
+            self._indexes.popitem(last=False)
+        return index
+
+    async def remember(self, user_id: int, question: str, answer: str):
+        """Сохранить пару вопрос-ответ"""
+        limit = config.MEMORY_SNIPPET_CHARS
+        text = f"Пользователь: {question[:limit]}\nАссистент: {answer[:limit]}"
+        index = await self._index(user_id)
+        index.add(await db.add_memory_snippet(user_id, text), text)
+        self.remembered += 1
+        if len(index) > self.max_snippets:
+            await db.delete_memory_snippets(user_id, up_to_id=index.remove_oldest())
+
+    async def recall(self, user_id: int, query: str, exclude_recent: int) -> list[str]:
+        """
+        Фрагменты, относящиеся к запросу. exclude_recent последних пар
+        еще есть в истории диалога целиком — их не дублируем.
+        """
+        started = time.monotonic()
+        index = await self._index(user_id)
+        results = index.search(query, config.MEMORY_TOP_K, exclude_recent)
+        snippets = [text for score, text in results if score >= config.MEMORY_MIN_SCORE]
+        self.searches += 1
+        self.search_time += time.monotonic() - started
+        if snippets:
+            self.hits += 1
+        return snippets
+
+    async def forget(self, user_id: int):
+        """Удалить память пользователя"""
+        self._indexes.pop(user_id, None)
+        await db.delete_memory_snippets(user_id)
+
+    def stats(self) -> dict:
+        """Индексы в памяти и результативность поиска"""
+        return {
+            "loaded_users": len(self._indexes),
+            "remembered": self.remembered,
+            "searches": self.searches,
+            "hit_ratio": self.hits / self.searches if self.searches else 0.0,
+            "avg_search_ms": self.search_time / self.searches * 1000 if self.searches else 0.0,
+        }
+
+
+def format_snippets(snippets: list[str]) -> dict:
+    """Системное сообщение с фрагментами прошлых разговоров"""
+    body = "\n\n".join(snippets)
+    return {
+        "role": "system",
+        "content": f"Фрагменты прошлых разговоров с пользователем (используй, если они относятся к вопросу):\n\n{body}",
+    }
+
+
+long_memory = LongTermMemory(config.MEMORY_MAX_SNIPPETS, config.MEMORY_MAX_USERS)
+metrics.register("long_memory", long_memory.stats)
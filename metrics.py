@@ -0,0 +1,35 @@
+"""
+Метрики производительности бота
+"""
+from typing import Callable
+
+# Источники метрик: имя -> функция, возвращающая словарь значений
+_providers: dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, provider: Callable[[], dict]):
+    """Зарегистрировать источник метрик"""
+    _providers[name] = provider
+
+
+def collect() -> dict[str, dict]:
+    """Собрать текущие значения со всех источников"""
+    return {name: provider() for name, provider in _providers.items()}
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
+def format_report() -> str:
+    """Сформировать отчет для админа"""
+    lines = ["⚡ <b>Производительность</b>"]
+    for name, values in collect().items():
+        lines.append(f"\n<b>{name}</b>")
+        for key, value in values.items():
+            lines.append(f"• {key}: {_format_value(value)}")
+    if len(lines) == 1:
+        lines.append("\nМетрик пока нет")
+    return "\n".join(lines)
@@ -0,0 +1,50 @@
+"""
+Локальный HTTP-эндпоинт метрик: /metrics (Prometheus) и /metrics.json
+"""
+import logging
+import re
+
+from aiohttp import web
+
+import metrics
+from tracing import latency
+
+logger = logging.getLogger(__name__)
+
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _metric_name(*parts: str) -> str:
+    return _NAME_RE.sub("_", "_".join(("neuralbot",) + parts))
+
+
+def prometheus_text() -> str:
+    """Числовые метрики как gauge плюс гистограммы этапов"""
+    lines = []
+    for provider, values in metrics.collect().items():
+        for key, value in values.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                lines.append(f"{_metric_name(provider, key)} {value}")
+    return "\n".join(lines) + "\n" + latency.prometheus()
+
+
+async def _metrics(request: web.Request) -> web.Response:
+    return web.Response(text=prometheus_text(), content_type="text/plain")
+
+
+async def _metrics_json(request: web.Request) -> web.Response:
+    return web.json_response(metrics.collect())
+
+
+async def start(host: str, port: int) -> web.AppRunner:
+    """Запустить сервер метрик; остановка — await runner.cleanup()"""
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    app.router.add_get("/metrics.json", _metrics_json)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint: http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,221 @@
+"""
+Локальная заглушка OpenAI Chat Completions для нагрузочного тестирования
+
+Запуск:
+    python mock_openai.py --port 8001 --ttft lognormal:0.8:0.5 --tokens-per-second 60 --error-429 0.02
+
+И в .env бота:
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from collections import deque
+
+from aiohttp import web
+
+WORDS = (
+    "конечно вот подробный ответ на ваш вопрос давайте разберем по шагам "
+    "во-первых важно учитывать контекст во-вторых стоит проверить данные "
+    "например можно использовать простой подход который хорошо работает"
+).split()
+
+
+def parse_distribution(spec: str):
+    """
+    Распределение задержки в секундах:
+    fixed:0.5, uniform:0.2:1.5, exp:0.7 (среднее), lognormal:0.8:0.5 (медиана, сигма)
+    """
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0, sigma)
+    raise ValueError(f"Unknown distribution: {spec}")
+
+
+def estimate_tokens(text: str) -> int:
+    return max(len(text) // 3, 1)
+
+
+class MockOpenAI:
+    """Состояние заглушки: лимиты, "кэш" префиксов промптов и счетчики"""
+
+    def __init__(self, args):
+        self.args = args
+        self.ttft = parse_distribution(args.ttft)
+        self._window: deque = deque()
+        self._prefixes: set[str] = set()
+        self.requests = 0
+        self.errors = 0
+
+    def _rate_limit_headers(self, tokens: int) -> tuple[dict, bool]:
+        """Заголовки x-ratelimit-* и признак превышения лимитов"""
+        now = time.monotonic()
+        while self._window and self._window[0][0] <= now - 60:
+            self._window.popleft()
+        used_requests = len(self._window)
+        used_tokens = sum(t for _, t in self._window)
+        exceeded = used_requests >= self.args.rpm or used_tokens + tokens > self.args.tpm
+        if not exceeded:
+            self._window.append((now, tokens))
+            used_requests += 1
+            used_tokens += tokens
+        reset = self._window[0][0] + 60 - now if self._window else 0.0
+        headers = {
+            "x-ratelimit-limit-requests": str(self.args.rpm),
+            "x-ratelimit-limit-tokens": str(self.args.tpm),
+            "x-ratelimit-remaining-requests": str(max(self.args.rpm - used_requests, 0)),
+            "x-ratelimit-remaining-tokens": str(max(self.args.tpm - used_tokens, 0)),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+            "x-ratelimit-reset-tokens": f"{reset:.3f}s",
+        }
+        return headers, exceeded
+
+    def _cached_tokens(self, messages: list[dict]) -> int:
+        """Имитация кэша промптов: самый длинный ранее виденный префикс из сообщений"""
+        digest = hashlib.sha256()
+        cached = 0
+        prefix_tokens = 0
+        for message in messages[:-1]:
+            digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            prefix_tokens += estimate_tokens(message.get("content") or "") + 4
+            key = digest.hexdigest()
+            if key in self._prefixes:
+                cached = prefix_tokens
+            self._prefixes.add(key)
+        # Как у OpenAI: кэш от 1024 токенов, шагами по 128
+        return cached // 128 * 128 if cached >= 1024 else 0
+
+    def _error(self, status: int, message: str, headers: dict) -> web.Response:
+        self.errors += 1
+        headers = dict(headers, **{"retry-after": "1"})
+        return web.json_response(
+            {"error": {"message": message, "type": "mock_error", "code": str(status)}},
+            status=status,
+            headers=headers
+        )
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        messages = body.get("messages", [])
+        model = body.get("model", "gpt-4o-mini")
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or 1000
+
+        prompt_tokens = sum(estimate_tokens(m.get("content") or "") + 4 for m in messages) + 3
+        headers, exceeded = self._rate_limit_headers(prompt_tokens + max_tokens)
+        if exceeded:
+            return self._error(429, "Rate limit reached (mock)", headers)
+        if random.random() < self.args.error_429:
+            return self._error(429, "Injected rate limit (mock)", headers)
+        if random.random() < self.args.error_500:
+            return self._error(500, "Injected server error (mock)", headers)
+
+        completion_tokens = min(
+            max_tokens, random.randint(self.args.min_completion, self.args.max_completion)
+        )
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": self._cached_tokens(messages)},
+        }
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        tokens = [random.choice(WORDS) + " " for _ in range(completion_tokens)]
+
+        await asyncio.sleep(self.ttft())
+
+        if not body.get("stream"):
+            await asyncio.sleep(completion_tokens / self.args.tokens_per_second)
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }, headers=headers)
+
+        response = web.StreamResponse(headers=dict(headers, **{"Content-Type": "text/event-stream"}))
+        await response.prepare(request)
+
+        def chunk(delta: dict, finish_reason=None) -> bytes:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        await response.write(chunk({"role": "assistant", "content": ""}))
+        # Токены отдаются пачками по chunk_tokens с заданной скоростью
+        step = self.args.chunk_tokens
+        for i in range(0, len(tokens), step):
+            await response.write(chunk({"content": "".join(tokens[i:i + step])}))
+            await asyncio.sleep(step / self.args.tokens_per_second)
+        await response.write(chunk({}, "stop"))
+
+        if (body.get("stream_options") or {}).get("include_usage"):
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }
+            await response.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "errors": self.errors})
+
+
+def build_app(args) -> web.Application:
+    mock = MockOpenAI(args)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", mock.chat_completions)
+    app.router.add_get("/stats", mock.stats)
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI Chat Completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", default="lognormal:0.6:0.5",
+                        help="Распределение времени до первого токена")
+    parser.add_argument("--tokens-per-second", type=float, default=80)
+    parser.add_argument("--chunk-tokens", type=int, default=4)
+    parser.add_argument("--min-completion", type=int, default=30)
+    parser.add_argument("--max-completion", type=int, default=300)
+    parser.add_argument("--error-429", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--error-500", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--rpm", type=int, default=500)
+    parser.add_argument("--tpm", type=int, default=200000)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    web.run_app(build_app(args), host=args.host, port=args.port)
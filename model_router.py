@@ -0,0 +1,135 @@
+"""
+Выбор модели для запроса: тариф, длина промпта, тип задачи и задержка провайдера
+"""
+import logging
+import re
+import time
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Признаки типов задач (проверяются по порядку)
+TASK_PATTERNS = [
+    ("code", re.compile(
+        r"```|\b(def|class|import|return|SELECT|function|const)\b|"
+        r"\b(код|кода|коде|python|javascript|java|sql|html|css|функци\w*|скрипт\w*|программ\w*|баг\w*|traceback)\b",
+        re.IGNORECASE
+    )),
+    ("translation", re.compile(
+        r"\b(переведи\w*|перевод\w*|translate|translation|tarjima)\b|\bна (английский|русский|узбекский)\b",
+        re.IGNORECASE
+    )),
+    ("chat", re.compile(
+        r"^\W*(привет|здравствуй\w*|салам|hi|hello|спасибо|благодарю|пока|как дела|кто ты|ок|ok)\b",
+        re.IGNORECASE
+    )),
+]
+
+
+def detect_task(message: str) -> str:
+    """Определить тип задачи: code, translation, chat или general"""
+    for task, pattern in TASK_PATTERNS:
+        if pattern.search(message):
+            return task
+    return "general"
+
+
+class ModelRouter:
+    """Подбирает модель по правилам MODEL_ROUTES и следит за временем до первого токена моделей"""
+
+    def __init__(self, routes: list[dict], fallbacks: dict[str, str], latency_limit: float):
+        self.routes = routes
+        self.fallbacks = fallbacks
+        self.latency_limit = latency_limit
+        # Сглаженное время до первого токена по моделям, секунды
+        self.latency: dict[str, float] = {}
+        self._observed_at: dict[str, float] = {}
+        self.decisions: dict[str, int] = {}
+        self._max_tokens_total: dict[str, int] = {}
+        self._max_tokens_count: dict[str, int] = {}
+
+    def observe(self, model: str, seconds: float):
+        """Учесть время до первого токена модели (таймаут — как время до первого токена)"""
+        previous = self.latency.get(model)
+        self.latency[model] = seconds if previous is None else previous * 0.8 + seconds * 0.2
+        self._observed_at[model] = time.monotonic()
+
+    def _is_slow(self, model: str) -> bool:
+        # Пока модель заменена запасной, новых замеров нет — старые со временем забываем
+        observed_at = self._observed_at.get(model)
+        if observed_at is None or time.monotonic() - observed_at > config.MODEL_LATENCY_TTL:
+            return False
+        return self.latency[model] > self.latency_limit
+
+    def _match(self, rule: dict, tier: str, task: str, prompt_tokens: int) -> bool:
+        if "tier" in rule and rule["tier"] != tier:
+            return False
+        if "task" in rule and rule["task"] != task:
+            return False
+        if prompt_tokens < rule.get("min_tokens", 0):
+            return False
+        if prompt_tokens > rule.get("max_tokens", prompt_tokens):
+            return False
+        return True
+
+    def route(self, user_id: int, tier: str, task: str, prompt_tokens: int, mode: str = "auto") -> str:
+        """Выбрать модель для запроса (в режиме — модель режима для тарифа)"""
+        model, reason = config.GPT_MODEL, "default"
+        if mode in config.MODES:
+            model, reason = config.MODES[mode]["models"][tier], f"mode {mode}"
+        else:
+            for index, rule in enumerate(self.routes):
+                if self._match(rule, tier, task, prompt_tokens):
+                    model, reason = rule["model"], f"rule {index}"
+                    break
+
+        # Медленную модель временно заменяем запасной
+        fallback = self.fallbacks.get(model)
+        if fallback and self._is_slow(model):
+            reason = f"{reason}, {model} ttft {self.latency[model]:.1f}s"
+            model = fallback
+
+        key = f"{tier}:{model}"
+        self.decisions[key] = self.decisions.get(key, 0) + 1
+        logger.info(
+            "route user=%s tier=%s task=%s prompt_tokens=%s model=%s (%s)",
+            user_id, tier, task, prompt_tokens, model, reason
+        )
+        return model
+
+    def max_tokens(self, model: str, tier: str, task: str, prompt_tokens: int, mode: str = "auto") -> int:
+        """
+        Лимит длины ответа: меньшее из значения по умолчанию для задачи (или режима),
+        потолка тарифа и места, оставшегося в контексте модели после промпта.
+        Меньший max_tokens меньше резервирует в TPM-лимите OpenAI.
+        """
+        context = config.MODEL_CONTEXT_WINDOWS.get(model, config.DEFAULT_CONTEXT_WINDOW)
+        remaining = context - prompt_tokens - config.CONTEXT_SAFETY_MARGIN
+        if mode in config.MODES:
+            default = config.MODES[mode]["max_tokens"]
+        else:
+            default = config.MAX_TOKENS_BY_TASK.get(task, config.MAX_TOKENS_BY_TASK["general"])
+        value = min(
+            default,
+            config.MAX_TOKENS_BY_TIER[tier],
+            remaining,
+        )
+        value = max(value, config.MIN_MAX_TOKENS)
+        self._max_tokens_total[tier] = self._max_tokens_total.get(tier, 0) + value
+        self._max_tokens_count[tier] = self._max_tokens_count.get(tier, 0) + 1
+        return value
+
+    def stats(self) -> dict:
+        """Решения по тарифам и задержка моделей"""
+        result = dict(sorted(self.decisions.items()))
+        for tier, count in self._max_tokens_count.items():
+            result[f"avg_max_tokens_{tier}"] = self._max_tokens_total[tier] / count
+        for model, seconds in self.latency.items():
+            result[f"ttft_{model}_s"] = seconds
+        return result
+
+
+router = ModelRouter(config.MODEL_ROUTES, config.MODEL_FALLBACKS, config.MODEL_LATENCY_LIMIT)
+metrics.register("model_router", router.stats)
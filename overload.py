@@ -0,0 +1,153 @@
+"""
+Контроль перегрузки: уровни деградации по очереди, задержке OpenAI и задержке event loop
+"""
+import asyncio
+import logging
+import time
+
+import config
+import database as db
+import metrics
+from job_queue import ai_jobs
+from scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+# Уровни деградации (каждый включает меры предыдущих)
+NORMAL = 0
+SHORT_ANSWERS = 1   # Меньше max_tokens
+CHEAP_MODEL = 2     # Бесплатные пользователи — на дешевую модель
+NO_HISTORY = 3      # История диалога не отправляется
+SHED_FREE = 4       # Бесплатным пользователям — "попробуйте позже"
+
+LEVEL_NAMES = ("normal", "short_answers", "cheap_model", "no_history", "shed_free")
+
+
+class OverloadController:
+    """
+    Нагрузка — максимум из отношений сигналов к их порогам: глубины очереди,
+    сглаженного времени до первого токена и задержки event loop.
+    При AI_JOB_BACKEND=sqlite в глубину очереди входят задания, ждущие в БД.
+    Уровень повышается сразу, как только нагрузка дошла до порога уровня,
+    а понижается на один шаг, когда нагрузка упала ниже порога, умноженного
+    на OVERLOAD_HYSTERESIS, и уровень продержался OVERLOAD_MIN_DWELL секунд.
+    """
+
+    def __init__(self, thresholds: list[float], hysteresis: float, min_dwell: float):
+        self.thresholds = thresholds
+        self.hysteresis = hysteresis
+        self.min_dwell = min_dwell
+        self.level = NORMAL
+        self.pressure = 0.0
+        self._changed_at = time.monotonic()
+        self._ttft = 0.0
+        self._ttft_at = 0.0
+        self.loop_lag = 0.0
+        self.db_queued = 0
+        self._db_polled_at = 0.0
+        self.transitions = 0
+        self.shed = 0
+        self._task = None
+
+    def observe_ttft(self, seconds: float):
+        """Учесть время до первого токена OpenAI"""
+        self._ttft = self._ttft * 0.8 + seconds * 0.2 if self._ttft else seconds
+        self._ttft_at = time.monotonic()
+
+    def _queue_depth(self) -> int:
+        return scheduler.waiting + ai_jobs.depth + self.db_queued
+
+    async def _poll_db_queue(self):
+        now = time.monotonic()
+        if now - self._db_polled_at < config.OVERLOAD_DB_POLL_INTERVAL:
+            return
+        self._db_polled_at = now
+        try:
+            self.db_queued = await db.count_queued_ai_jobs()
+        except Exception as e:
+            logger.error(f"Failed to count queued AI jobs: {e}")
+
+    def _signals(self) -> dict:
+        # Без свежих замеров задержка OpenAI не учитывается
+        ttft = self._ttft if time.monotonic() - self._ttft_at < config.OVERLOAD_SIGNAL_TTL else 0.0
+        return {
+            "queue": self._queue_depth() / config.OVERLOAD_QUEUE_DEPTH,
+            "ttft": ttft / config.OVERLOAD_TTFT,
+            "loop_lag": self.loop_lag / config.OVERLOAD_LOOP_LAG,
+        }
+
+    def evaluate(self):
+        """Пересчитать нагрузку и уровень"""
+        self.pressure = max(self._signals().values())
+        now = time.monotonic()
+
+        target = NORMAL
+        for level, threshold in enumerate(self.thresholds, start=1):
+            if self.pressure >= threshold:
+                target = level
+
+        if target > self.level:
+            self._set_level(target, now)
+        elif (
+            self.level > NORMAL
+            and self.pressure < self.thresholds[self.level - 1] * self.hysteresis
+            and now - self._changed_at >= self.min_dwell
+        ):
+            self._set_level(self.level - 1, now)
+
+    def _set_level(self, level: int, now: float):
+        logger.warning(
+            "Overload level %s -> %s (pressure %.2f)",
+            LEVEL_NAMES[self.level], LEVEL_NAMES[level], self.pressure
+        )
+        self.level = level
+        self._changed_at = now
+        self.transitions += 1
+
+    def should_shed(self, is_premium: bool) -> bool:
+        """Отказать запросу бесплатного пользователя"""
+        if is_premium or self.level < SHED_FREE:
+            return False
+        self.shed += 1
+        return True
+
+    async def _monitor(self):
+        interval = config.OVERLOAD_CHECK_INTERVAL
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = max(time.monotonic() - started - interval, 0.0)
+            self.loop_lag = self.loop_lag * 0.7 + lag * 0.3
+            if config.AI_JOB_BACKEND == "sqlite":
+                await self._poll_db_queue()
+            self.evaluate()
+
+    def start(self):
+        """Запустить фоновый контроль"""
+        self._task = asyncio.create_task(self._monitor())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        """Текущий уровень и сигналы"""
+        result = {
+            "level": self.level,
+            "level_name": LEVEL_NAMES[self.level],
+            "pressure": self.pressure,
+            "transitions": self.transitions,
+            "shed": self.shed,
+        }
+        for name, value in self._signals().items():
+            result[f"{name}_pressure"] = value
+        return result
+
+
+overload = OverloadController(
+    config.OVERLOAD_THRESHOLDS,
+    config.OVERLOAD_HYSTERESIS,
+    config.OVERLOAD_MIN_DWELL,
+)
+metrics.register("overload", overload.stats)
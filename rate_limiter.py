@@ -0,0 +1,140 @@
+"""
+Общий ограничитель запросов к OpenAI (RPM и TPM)
+"""
+import asyncio
+import re
+import time
+from collections import deque
+from typing import Optional
+
+import config
+import metrics
+
+WINDOW = 60.0  # Лимиты OpenAI считаются за минуту
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: str) -> Optional[float]:
+    """Разобрать x-ratelimit-reset-* ("1s", "6m0s", "20ms") в секунды"""
+    parts = _DURATION_RE.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class RateLimiter:
+    """Скользящее окно по запросам и токенам; лишние вызовы ждут в очереди"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        # Записи окна: [время, запросов, токенов]
+        self._events: deque[list] = deque()
+        # asyncio.Lock пропускает ожидающих по очереди (FIFO)
+        self._lock = asyncio.Lock()
+        self.waiting = 0
+        self.acquired = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+
+    def _purge(self, now: float):
+        while self._events and self._events[0][0] <= now - WINDOW:
+            self._events.popleft()
+
+    def _usage(self) -> tuple[int, int]:
+        requests = sum(event[1] for event in self._events)
+        tokens = sum(event[2] for event in self._events)
+        return requests, tokens
+
+    async def acquire(self, tokens: int) -> list:
+        """Дождаться места в лимитах и зарезервировать запрос"""
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._purge(now)
+                    used_requests, used_tokens = self._usage()
+                    # Запрос больше всего лимита пропускаем в пустое окно, иначе он ждал бы вечно
+                    fits_tokens = used_tokens + tokens <= self.tpm or used_tokens == 0
+                    if used_requests < self.rpm and fits_tokens:
+                        event = [now, 1, tokens]
+                        self._events.append(event)
+                        break
+                    await asyncio.sleep(max(self._events[0][0] + WINDOW - now, 0.01))
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.total_wait += waited
+        if waited > 0.01:
+            self.delayed += 1
+        return event
+
+    def settle(self, event: list, actual_tokens: int):
+        """
+        Учесть фактический расход, если он больше резерва. Меньше резерв не
+        становится: OpenAI считает TPM по max_tokens в момент запроса.
+        """
+        event[2] = max(event[2], actual_tokens)
+
+    def update_from_headers(self, headers):
+        """Подстроиться под x-ratelimit-* заголовки ответа OpenAI"""
+        now = time.monotonic()
+        self._purge(now)
+        used_requests, used_tokens = self._usage()
+
+        for kind, index in (("requests", 1), ("tokens", 2)):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+            if limit is None or remaining is None:
+                continue
+            try:
+                limit, remaining = int(limit), int(remaining)
+            except ValueError:
+                continue
+
+            if kind == "requests":
+                self.rpm = min(limit, config.OPENAI_RPM_LIMIT)
+                local_used = used_requests
+            else:
+                self.tpm = min(limit, config.OPENAI_TPM_LIMIT)
+                local_used = used_tokens
+
+            # Расход, которого мы не видим (другие процессы с тем же ключом),
+            # учитываем фиктивной записью, истекающей к моменту сброса лимита
+            external = (limit - remaining) - local_used
+            if external > 0 and reset:
+                event = [now + min(reset, WINDOW) - WINDOW, 0, 0]
+                event[index] = external
+                self._insert(event)
+
+    def _insert(self, event: list):
+        # Окно должно оставаться упорядоченным по времени
+        position = len(self._events)
+        while position > 0 and self._events[position - 1][0] > event[0]:
+            position -= 1
+        self._events.insert(position, event)
+
+    def stats(self) -> dict:
+        """Текущее состояние лимитов"""
+        self._purge(time.monotonic())
+        used_requests, used_tokens = self._usage()
+        return {
+            "rpm_limit": self.rpm,
+            "tpm_limit": self.tpm,
+            "window_requests": used_requests,
+            "window_tokens": used_tokens,
+            "waiting": self.waiting,
+            "delayed": self.delayed,
+            "avg_wait_s": self.total_wait / self.acquired if self.acquired else 0.0,
+        }
+
+
+rate_limiter = RateLimiter(config.OPENAI_RPM_LIMIT, config.OPENAI_TPM_LIMIT)
+metrics.register("openai_rate_limit", rate_limiter.stats)
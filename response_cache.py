@@ -0,0 +1,262 @@
+"""
+Кэш ответов AI для первых сообщений диалога
+"""
+import hashlib
+import random
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+import config
+import metrics
+
+
+def normalize_text(text: str) -> str:
+    """Нормализовать текст запроса для сравнения"""
+    return " ".join(text.lower().split())
+
+
+def make_key(model: str, system_prompt: str, message: str) -> str:
+    """Ключ кэша: модель + системный промпт + нормализованное сообщение"""
+    raw = "\x00".join((model, system_prompt, normalize_text(message)))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# Сообщения, ответы на которые нельзя переиспользовать (время, личные данные)
+_exclude_patterns = [
+    re.compile(pattern, re.IGNORECASE) for pattern in config.RESPONSE_CACHE_EXCLUDE
+]
+
+
+def is_cacheable(message: str) -> bool:
+    """Можно ли кэшировать ответ на это сообщение"""
+    if len(message) > config.RESPONSE_CACHE_MAX_MESSAGE_LENGTH:
+        return False
+    return not any(pattern.search(message) for pattern in _exclude_patterns)
+
+
+class ResponseCache:
+    """LRU-кэш ответов с ограничением по размеру и времени жизни"""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """Получить ответ из кэша"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def set(self, key: str, response: str):
+        """Сохранить ответ в кэш"""
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Очистить кэш"""
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """Статистика попаданий"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+_WORD_RE = re.compile(r"\w+")
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def shingles(text: str) -> set[str]:
+    """Слова и символьные триграммы слов (порядок слов не важен)"""
+    result = set()
+    for word in _WORD_RE.findall(text.lower()):
+        result.add(word)
+        padded = f"#{word}#"
+        for i in range(len(padded) - 2):
+            result.add(padded[i:i + 3])
+    return result
+
+
+def exact_tokens(text: str) -> tuple:
+    """
+    Числа и слова из 1-2 букв ("2+2", "не"): на сходство шинглов они почти
+    не влияют, но меняют смысл вопроса, поэтому должны совпадать точно
+    """
+    return tuple(sorted(
+        word for word in _WORD_RE.findall(text.lower())
+        if len(word) <= 2 or any(char.isdigit() for char in word)
+    ))
+
+
+class NearDuplicateIndex:
+    """Поиск почти совпадающих запросов через MinHash + LSH"""
+
+    def __init__(self, max_size: int, ttl: int, num_perm: int, bands: int, threshold: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        rng = random.Random(42)
+        self._perms = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(self.bands * self.rows)
+        ]
+        # id записи -> (scope, сигнатура, точные слова, порог, срок жизни, ответ)
+        self._entries: OrderedDict[int, tuple[str, tuple, tuple, float, float, str]] = OrderedDict()
+        self._buckets: dict[tuple, set[int]] = {}
+        # Одинаковые запросы хранятся одной записью
+        self._by_signature: dict[tuple, int] = {}
+        self._next_id = 0
+        self.lookups = 0
+        self.hits = 0
+        self._confidence_sum = 0.0
+
+    def _signature(self, text: str) -> Optional[tuple]:
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles(text)]
+        if not hashes:
+            return None
+        return tuple(
+            min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+            for a, b in self._perms
+        )
+
+    def _band_keys(self, scope: str, signature: tuple):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield (scope, band, signature[start:start + self.rows])
+
+    def _entry_threshold(self, text: str) -> float:
+        # Для коротких запросов оценка MinHash шумная — требуем большего сходства
+        if len(shingles(text)) < config.NEAR_CACHE_SHORT_SHINGLES:
+            return max(self.threshold, config.NEAR_CACHE_SHORT_THRESHOLD)
+        return self.threshold
+
+    def _remove(self, entry_id: int):
+        scope, signature, exact, _, _, _ = self._entries.pop(entry_id)
+        self._by_signature.pop((scope, signature, exact), None)
+        for key in self._band_keys(scope, signature):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def lookup(self, scope: str, text: str) -> Optional[tuple[str, float]]:
+        """Найти похожий запрос: (ответ, уверенность) или None"""
+        self.lookups += 1
+        signature = self._signature(text)
+        if signature is None:
+            return None
+        exact = exact_tokens(text)
+
+        candidates = set()
+        for key in self._band_keys(scope, signature):
+            candidates |= self._buckets.get(key, set())
+
+        now = time.monotonic()
+        best = None
+        for entry_id in candidates:
+            _, entry_signature, entry_exact, min_similarity, expires_at, response = self._entries[entry_id]
+            if expires_at < now:
+                self._remove(entry_id)
+                continue
+            if entry_exact != exact:
+                continue
+            matches = sum(1 for x, y in zip(signature, entry_signature) if x == y)
+            similarity = matches / len(signature)
+            if similarity >= min_similarity and (best is None or similarity > best[1]):
+                best = (response, similarity, entry_id)
+
+        if best is None:
+            return None
+
+        self._entries.move_to_end(best[2])
+        self.hits += 1
+        self._confidence_sum += best[1]
+        return best[0], best[1]
+
+    def add(self, scope: str, text: str, response: str):
+        """Добавить запрос и ответ в индекс"""
+        signature = self._signature(text)
+        if signature is None:
+            return
+        exact = exact_tokens(text)
+
+        previous = self._by_signature.get((scope, signature, exact))
+        if previous is not None:
+            self._remove(previous)
+
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (
+            scope, signature, exact, self._entry_threshold(text), time.monotonic() + self.ttl, response
+        )
+        self._by_signature[(scope, signature, exact)] = entry_id
+        for key in self._band_keys(scope, signature):
+            self._buckets.setdefault(key, set()).add(entry_id)
+
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        """Очистить индекс"""
+        self._entries.clear()
+        self._buckets.clear()
+        self._by_signature.clear()
+
+    def stats(self) -> dict:
+        """Статистика поиска похожих запросов"""
+        return {
+            "size": len(self._entries),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "avg_confidence": self._confidence_sum / self.hits if self.hits else 0.0,
+        }
+
+
+def make_scope(model: str, system_prompt: str) -> str:
+    """Область индекса: ответы разных моделей и промптов не смешиваются"""
+    raw = "\x00".join((model, system_prompt))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+response_cache = ResponseCache(config.RESPONSE_CACHE_SIZE, config.RESPONSE_CACHE_TTL)
+metrics.register("response_cache", response_cache.stats)
+
+near_cache = NearDuplicateIndex(
+    config.RESPONSE_CACHE_SIZE,
+    config.RESPONSE_CACHE_TTL,
+    config.NEAR_CACHE_PERMUTATIONS,
+    config.NEAR_CACHE_BANDS,
+    config.NEAR_CACHE_THRESHOLD,
+)
+metrics.register("near_cache", near_cache.stats)
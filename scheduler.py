@@ -0,0 +1,102 @@
+"""
+Приоритетная очередь запросов к AI (Premium обслуживается первым)
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+import config
+import metrics
+
+TIERS = ("premium", "free")
+
+
+class PriorityScheduler:
+    """
+    Ограниченный пул одновременных запросов к OpenAI.
+
+    Очередь упорядочена по "виртуальному" времени постановки: Premium-запрос
+    считается поставленным на PRIORITY_HEAD_START секунд раньше. Поэтому
+    бесплатный запрос, прождавший дольше этой форы, обходит новые Premium-запросы
+    и не голодает.
+    """
+
+    def __init__(self, max_inflight: int, head_start: float):
+        self.max_inflight = max_inflight
+        self.head_start = head_start
+        self._inflight = 0
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._tiers = {
+            tier: {"queued": 0, "served": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for tier in TIERS
+        }
+
+    def _record_wait(self, tier: str, waited: float):
+        stats = self._tiers[tier]
+        stats["served"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+
+    async def _acquire(self, tier: str):
+        if self._inflight < self.max_inflight and not self._queue:
+            self._inflight += 1
+            self._record_wait(tier, 0.0)
+            return
+
+        enqueued_at = time.monotonic()
+        score = enqueued_at - (self.head_start if tier == "premium" else 0.0)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (score, next(self._seq), future))
+        self._tiers[tier]["queued"] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот мог быть выдан одновременно с отменой — возвращаем его
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        finally:
+            self._tiers[tier]["queued"] -= 1
+
+        self._record_wait(tier, time.monotonic() - enqueued_at)
+
+    def _release(self):
+        self._inflight -= 1
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                self._inflight += 1
+                future.set_result(None)
+                return
+
+    @asynccontextmanager
+    async def slot(self, tier: str):
+        """Занять место в пуле запросов с учетом приоритета тарифа"""
+        await self._acquire(tier)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @property
+    def waiting(self) -> int:
+        """Запросов, ждущих слота"""
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        """Глубина очереди и ожидание по тарифам"""
+        result = {"inflight": self._inflight, "max_inflight": self.max_inflight}
+        for tier, stats in self._tiers.items():
+            served = stats["served"]
+            result[f"{tier}_queued"] = stats["queued"]
+            result[f"{tier}_served"] = served
+            result[f"{tier}_avg_wait_s"] = stats["wait_total"] / served if served else 0.0
+            result[f"{tier}_max_wait_s"] = stats["wait_max"]
+        return result
+
+
+scheduler = PriorityScheduler(config.AI_MAX_CONCURRENT, config.PRIORITY_HEAD_START)
+metrics.register("ai_queue", scheduler.stats)
@@ -0,0 +1,61 @@
+"""
+Объединение одинаковых одновременных запросов к AI в один вызов
+"""
+import asyncio
+
+import metrics
+
+
+class SingleFlight:
+    """
+    Первый запрос с ключом (ведущий) выполняет вызов, остальные с тем же
+    ключом ждут его результат. Если вызов ведущего не удался или отменен,
+    из ждущих выбирается новый ведущий: ошибка одного пользователя не достается
+    другим, а к OpenAI, который и так ошибается, не уходит N вызовов разом.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.fallbacks = 0
+
+    async def do(self, key: str, call) -> tuple[object, bool]:
+        """Результат call() и признак, что он получен вызовом другого запроса"""
+        fell_back = False
+        while (future := self._calls.get(key)) is not None:
+            # shield: отмена одного ждущего не отменяет ожидание остальных
+            result = await asyncio.shield(future)
+            if result is not None:
+                self.followers += 1
+                return result, True
+            # Ведущий ушел без результата: первый проснувшийся станет новым ведущим
+            if not fell_back:
+                fell_back = True
+                self.fallbacks += 1
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self.leaders += 1
+        result = None
+        try:
+            result = await call()
+            return result, False
+        finally:
+            del self._calls[key]
+            # None — сигнал ждущим, что результата нет
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        """Сколько запросов обслужено одним вызовом"""
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "fallbacks": self.fallbacks,
+            # Запросов на один вызов к AI: ждущий в счет, только если получил чужой результат
+            "fan_out_ratio": (self.leaders + self.followers) / self.leaders if self.leaders else 0.0,
+        }
+
+
+singleflight = SingleFlight()
+metrics.register("singleflight", singleflight.stats)
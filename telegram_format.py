@@ -0,0 +1,259 @@
+"""
+Преобразование Markdown ответа модели в HTML для Telegram с разбиением на сообщения
+"""
+import html
+import re
+
+import config
+
+# Запас под теги <pre><code class="language-..."> при переносе блока кода в новое сообщение
+_RESERVE = 100
+
+_FENCE_RE = re.compile(r"^\s*```\s*([\w+#.-]*)\s*$")
+_HEADER_RE = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+_BULLET_RE = re.compile(r"^(\s*)[-*+]\s+")
+_LINK_RE = re.compile(r"\[([^\]\n]+)\]\((https?://[^\s)]+)\)")
+_TAG_RE = re.compile(r"<[^>]+>")
+
+# Маркер Markdown -> тег Telegram
+_MARKERS = {"**": "b", "__": "b", "~~": "s", "*": "i", "_": "i"}
+_CLOSE_CODE = "</code></pre>"
+
+
+def _is_word(char: str) -> bool:
+    return char.isalnum()
+
+
+def _close_marker(stack: list[tuple[str, int]], marker: str, run: int):
+    """Какой открытый маркер закрывает серия run символов, начинающаяся с marker"""
+    if not stack:
+        return None
+    top = stack[-1][0]
+    # Серия длиннее маркера (***) закрывает сначала внутренний
+    if run > len(marker) and top[0] == marker[0]:
+        return top
+    if any(m == marker for m, _ in stack):
+        return marker
+    if top[0] == marker[0] and len(top) < len(marker):
+        return top
+    return None
+
+
+def render_inline(line: str) -> str:
+    """
+    Строка Markdown -> HTML. Незакрытые маркеры остаются текстом,
+    поэтому теги в результате всегда сбалансированы.
+    """
+    parts: list[str] = []
+    # Открытые маркеры: (маркер, индекс открывающего тега в parts)
+    stack: list[tuple[str, int]] = []
+    i = 0
+    length = len(line)
+
+    while i < length:
+        char = line[i]
+
+        if char == "`":
+            end = line.find("`", i + 1)
+            if end > i + 1:
+                parts.append(f"<code>{html.escape(line[i + 1:end], quote=False)}</code>")
+                i = end + 1
+                continue
+
+        if char == "[":
+            match = _LINK_RE.match(line, i)
+            if match:
+                text, url = match.groups()
+                parts.append(
+                    f'<a href="{html.escape(url)}">{html.escape(text, quote=False)}</a>'
+                )
+                i = match.end()
+                continue
+
+        marker = line[i:i + 2] if line[i:i + 2] in _MARKERS else char if char in _MARKERS else None
+        if marker:
+            # Серия одинаковых символов (*** — это ** и *)
+            run = len(marker)
+            while i + run < length and line[i + run] == char:
+                run += 1
+            before = line[i - 1] if i else " "
+            after = line[i + run] if i + run < length else " "
+            # Подчеркивания внутри слов (snake_case) — не разметка
+            closer = _close_marker(stack, marker, run) if not before.isspace() else None
+            if closer and not (char == "_" and _is_word(after)):
+                position = max(j for j, (m, _) in enumerate(stack) if m == closer)
+                # Незакрытые маркеры внутри пары остаются текстом
+                _, index = stack[position]
+                del stack[position:]
+                parts[index] = f"<{_MARKERS[closer]}>"
+                parts.append(f"</{_MARKERS[closer]}>")
+                i += len(closer)
+                continue
+            after = line[i + len(marker)] if i + len(marker) < length else " "
+            if (
+                not after.isspace()
+                and not (char == "_" and _is_word(before))
+                and all(m != marker for m, _ in stack)
+            ):
+                # Пока не нашли пару, маркер хранится как текст
+                stack.append((marker, len(parts)))
+                parts.append(marker)
+                i += len(marker)
+                continue
+
+        parts.append(html.escape(char, quote=False))
+        i += 1
+
+    return "".join(parts)
+
+
+def render_line(line: str) -> str:
+    """Строка вне блока кода: заголовки, списки и строчная разметка"""
+    match = _HEADER_RE.match(line)
+    if match:
+        return f"<b>{render_inline(match.group(1))}</b>"
+    match = _BULLET_RE.match(line)
+    if match:
+        return f"{match.group(1)}• {render_inline(line[match.end():])}"
+    return render_inline(line)
+
+
+def to_plain(chunk: str) -> str:
+    """HTML-сообщение -> простой текст (если Telegram все же отклонил разметку)"""
+    return html.unescape(_TAG_RE.sub("", chunk))
+
+
+class TelegramRenderer:
+    """
+    Инкрементальный рендерер: принимает текст кусками по мере генерации,
+    готовые строки рендерит один раз и отдает законченные сообщения.
+    Сообщения режутся только между строками; блок кода, не влезший
+    в сообщение, закрывается и открывается заново в следующем.
+    """
+
+    def __init__(self, limit: int = None):
+        self.limit = limit or config.TELEGRAM_MESSAGE_LIMIT
+        self._buffer = ""
+        self._html = ""
+        self._code_tag = None
+        # Открывающий тег блока кода еще не выведен в текущее сообщение
+        self._code_pending = False
+        self._ready: list[str] = []
+
+    def feed(self, text: str) -> list[str]:
+        """Добавить кусок ответа; вернуть сообщения, которые уже не изменятся"""
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._add_line(line)
+        return self._take_ready()
+
+    def preview(self) -> str:
+        """Текущее незаконченное сообщение (для редактирования во время генерации)"""
+        result = self._html
+        tail = self._buffer
+        if self._code_tag is not None:
+            closed = result + ("" if self._code_pending else _CLOSE_CODE)
+            if tail and not _FENCE_RE.match(tail):
+                candidate = result + self._code_piece(html.escape(tail, quote=False)) + _CLOSE_CODE
+                if len(candidate) <= self.limit:
+                    return candidate
+            return closed
+        if tail and not _FENCE_RE.match(tail):
+            candidate = result + ("\n" if result else "") + render_line(tail)
+            if len(candidate) <= self.limit:
+                return candidate
+        return result
+
+    def finish(self) -> list[str]:
+        """Дорендерить остаток и вернуть все оставшиеся сообщения"""
+        if self._buffer:
+            self._add_line(self._buffer)
+            self._buffer = ""
+        if self._code_tag is not None:
+            self._add_line("```")
+        self._flush()
+        return self._take_ready()
+
+    def _take_ready(self) -> list[str]:
+        ready, self._ready = self._ready, []
+        return ready
+
+    def _flush(self):
+        chunk = self._html
+        if self._code_tag is not None and not self._code_pending:
+            chunk += _CLOSE_CODE
+        if chunk.strip():
+            self._ready.append(chunk)
+        self._html = ""
+        self._code_pending = self._code_tag is not None
+
+    def _code_piece(self, escaped: str) -> str:
+        if self._code_pending:
+            return ("\n" if self._html else "") + self._code_tag + escaped
+        return "\n" + escaped
+
+    def _append(self, make_piece):
+        # Вместе с куском должен поместиться закрывающий тег блока кода
+        reserve = len(_CLOSE_CODE) if self._code_tag is not None else 0
+        piece = make_piece()
+        if self._html and len(self._html) + len(piece) + reserve > self.limit:
+            self._flush()
+            piece = make_piece().lstrip("\n")
+        self._html += piece
+
+    def _add_line(self, line: str):
+        match = _FENCE_RE.match(line)
+        if match:
+            if self._code_tag is None:
+                language = match.group(1)
+                self._code_tag = (
+                    f'<pre><code class="language-{html.escape(language)}">' if language
+                    else "<pre><code>"
+                )
+                self._code_pending = True
+            else:
+                # Пустой блок кода не выводим вовсе
+                if not self._code_pending:
+                    self._html += _CLOSE_CODE
+                self._code_tag = None
+                self._code_pending = False
+            return
+
+        in_code = self._code_tag is not None
+        for part in self._split_long(line, in_code):
+            if in_code:
+                self._append(lambda: self._code_piece(part))
+                self._code_pending = False
+            else:
+                self._append(lambda: ("\n" if self._html else "") + part)
+
+    def _split_long(self, line: str, in_code: bool) -> list[str]:
+        """Отрендерить строку, разрезав слишком длинную по пробелам"""
+        budget = self.limit - _RESERVE
+        render = (lambda text: html.escape(text, quote=False)) if in_code else render_line
+        rendered = render(line)
+        if len(rendered) <= budget:
+            return [rendered]
+
+        parts = []
+        rest = line
+        while rest:
+            size = min(len(rest), budget)
+            while True:
+                cut = rest.rfind(" ", 0, size) if size < len(rest) else size
+                if cut <= 0:
+                    cut = size
+                rendered = render(rest[:cut])
+                if len(rendered) <= budget:
+                    break
+                size = max(size // 2, 1)
+            parts.append(rendered)
+            rest = rest[cut:]
+        return parts
+
+
+def render(text: str, limit: int = None) -> list[str]:
+    """Весь ответ целиком -> список HTML-сообщений"""
+    renderer = TelegramRenderer(limit)
+    return renderer.feed(text) + renderer.finish()
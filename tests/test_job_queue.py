@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from job_queue import AIJobQueue, QueueFullError
+
+
+def test_one_user_does_not_occupy_all_workers():
+    async def scenario():
+        running = []
+        release = asyncio.Event()
+
+        async def handler(job):
+            running.append(job["user_id"])
+            if job["user_id"] == 1:
+                await release.wait()
+
+        queue = AIJobQueue(max_size=10, workers=2, per_user=True)
+        queue.start(handler)
+        for _ in range(3):
+            queue.submit({"user_id": 1})
+        queue.submit({"user_id": 2})
+        await asyncio.sleep(0.01)
+
+        # Второй воркер свободен для другого пользователя
+        assert running == [1, 2]
+        assert queue.depth == 2
+
+        release.set()
+        await asyncio.sleep(0.01)
+        assert running == [1, 2, 1, 1]
+        assert queue.depth == 0
+        assert await queue.stop() == []
+
+    asyncio.run(scenario())
+
+
+def test_backlog_counts_towards_queue_size():
+    queue = AIJobQueue(max_size=2, workers=1, per_user=True)
+    queue.submit({"user_id": 1})
+    queue.submit({"user_id": 1})
+    with pytest.raises(QueueFullError):
+        queue.submit({"user_id": 1})
@@ -0,0 +1,37 @@
+import config
+from response_cache import NearDuplicateIndex, make_scope
+
+
+def make_index() -> NearDuplicateIndex:
+    return NearDuplicateIndex(
+        100, 3600, config.NEAR_CACHE_PERMUTATIONS, config.NEAR_CACHE_BANDS, config.NEAR_CACHE_THRESHOLD
+    )
+
+
+def test_near_duplicate_ignores_case_and_punctuation():
+    index = make_index()
+    scope = make_scope("gpt-4o-mini", "auto")
+    index.add(scope, "Привет!", "Здравствуйте!")
+
+    found = index.lookup(scope, "привет")
+
+    assert found is not None
+    assert found[0] == "Здравствуйте!"
+
+
+def test_near_duplicate_requires_same_numbers():
+    index = make_index()
+    scope = make_scope("gpt-4o-mini", "auto")
+    index.add(scope, "сколько будет 2+2", "4")
+
+    assert index.lookup(scope, "сколько будет 2+3") is None
+    assert index.lookup(scope, "сколько будет 2+2+2") is None
+    assert index.lookup(scope, "Сколько будет 2+2?")[0] == "4"
+
+
+def test_near_duplicate_requires_same_short_words():
+    index = make_index()
+    scope = make_scope("gpt-4o-mini", "auto")
+    index.add(scope, "почему небо голубое днем", "Рассеяние Рэлея")
+
+    assert index.lookup(scope, "почему небо не голубое днем") is None
@@ -0,0 +1,65 @@
+import re
+
+import pytest
+
+from telegram_format import TelegramRenderer, render, render_inline, to_plain
+
+SAMPLE = "\n".join([
+    "# Заголовок",
+    "Обычный текст с **жирным**, *курсивом*, _подчеркиванием_ и `кодом`.",
+    "- пункт со [ссылкой](https://example.com/a_b)",
+    "- snake_case_name и 2*3*4",
+    "```python",
+    *[f"print({i} * {i})  # строка {i}" for i in range(40)],
+    "```",
+    " ".join(["длинная строка без переносов"] * 40),
+    "***x*** и **bold *it** x*",
+])
+
+
+@pytest.mark.parametrize("markdown, expected", [
+    ("_italic_", "<i>italic</i>"),
+    ("__bold__", "<b>bold</b>"),
+    ("a __b__ c", "a <b>b</b> c"),
+    ("snake_case_name", "snake_case_name"),
+    ("file_name_", "file_name_"),
+    ("**a *b* c**", "<b>a <i>b</i> c</b>"),
+    ("***x***", "<b><i>x</i></b>"),
+    ("**bold *it** x*", "<b>bold *it</b> x*"),
+    ("`co*de*`", "<code>co*de*</code>"),
+    ("a < b", "a &lt; b"),
+])
+def test_render_inline(markdown, expected):
+    assert render_inline(markdown) == expected
+
+
+def _balanced(chunk: str) -> bool:
+    stack = []
+    for closing, tag in re.findall(r"<(/?)(\w+)[^>]*>", chunk):
+        if not closing:
+            stack.append(tag)
+        elif not stack or stack.pop() != tag:
+            return False
+    return not stack
+
+
+def test_split_respects_limit_and_balances_tags():
+    chunks = render(SAMPLE, limit=300)
+
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(chunk) <= 300
+        assert _balanced(chunk)
+    assert "".join(to_plain(chunk) for chunk in chunks).count("строка 39") == 1
+
+
+@pytest.mark.parametrize("step", [1, 7, 64])
+def test_streaming_equals_whole_render(step):
+    renderer = TelegramRenderer(300)
+    chunks = []
+    for start in range(0, len(SAMPLE), step):
+        chunks += renderer.feed(SAMPLE[start:start + step])
+        assert len(renderer.preview()) <= 300
+    chunks += renderer.finish()
+
+    assert chunks == render(SAMPLE, limit=300)
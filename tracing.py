@@ -0,0 +1,167 @@
+"""
+Разбивка задержки обработки сообщения по этапам: гистограммы и примеры медленных запросов
+"""
+import logging
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+class Trace:
+    """Этапы одного запроса: имя -> суммарная длительность (повторы складываются)"""
+
+    def __init__(self, path: str, user_id: int):
+        self.path = path
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self.stages: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+def start(path: str, user_id: int) -> Trace:
+    """Начать трассировку запроса в текущем контексте"""
+    trace = Trace(path, user_id)
+    _current.set(trace)
+    return trace
+
+
+def use(trace: Optional[Trace]):
+    """Продолжить трассировку в другой задаче (например, у воркера очереди)"""
+    _current.set(trace)
+
+
+def add(stage: str, seconds: float):
+    """Учесть этап, измеренный вручную"""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(stage: str):
+    """Измерить этап: with tracing.span("db_quota"): ..."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        add(stage, time.monotonic() - started)
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает перцентиль (не больше максимума)"""
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class LatencyRecorder:
+    """Гистограммы по этапам и последние медленные запросы"""
+
+    def __init__(self, slow_seconds: float, exemplars: int):
+        self.slow_seconds = slow_seconds
+        self.histograms: dict[str, _Histogram] = {}
+        self.exemplars: deque = deque(maxlen=exemplars)
+
+    def finish(self, trace: Optional[Trace]):
+        """Завершить трассировку и учесть ее этапы"""
+        if trace is None:
+            return
+        total = time.monotonic() - trace.started
+        trace.stages[f"total_{trace.path}"] = total
+        for stage, seconds in trace.stages.items():
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = _Histogram()
+            histogram.observe(seconds)
+
+        if total >= self.slow_seconds:
+            breakdown = ", ".join(
+                f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in trace.stages.items()
+            )
+            logger.warning(f"Slow {trace.path} user={trace.user_id} total={total:.2f}s: {breakdown}")
+            self.exemplars.append((time.time(), trace.user_id, dict(trace.stages)))
+
+    def stats(self) -> dict:
+        """p95 по этапам (для отчета производительности)"""
+        return {
+            f"{stage}_p95_s": histogram.percentile(0.95)
+            for stage, histogram in sorted(self.histograms.items())
+        }
+
+    def report(self) -> str:
+        """Отчет для админа: перцентили этапов и медленные запросы"""
+        lines = ["⏱ <b>Задержка по этапам</b> (p50 / p95 / p99 / max, мс)"]
+        for stage, histogram in sorted(self.histograms.items()):
+            values = " / ".join(
+                f"{value * 1000:.0f}" for value in (
+                    histogram.percentile(0.5), histogram.percentile(0.95),
+                    histogram.percentile(0.99), histogram.max,
+                )
+            )
+            lines.append(f"• {stage} ({histogram.count}): {values}")
+        if len(lines) == 1:
+            lines.append("\nЗамеров пока нет")
+
+        if self.exemplars:
+            lines.append(f"\n🐢 <b>Медленные запросы</b> (от {self.slow_seconds:g} с)")
+            for finished_at, user_id, stages in reversed(self.exemplars):
+                moment = time.strftime("%H:%M:%S", time.localtime(finished_at))
+                breakdown = ", ".join(f"{stage} {seconds * 1000:.0f}" for stage, seconds in stages.items())
+                lines.append(f"• {moment} <code>{user_id}</code>: {breakdown}")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        """Гистограммы в текстовом формате Prometheus"""
+        lines = [
+            "# HELP neuralbot_stage_seconds Message processing latency by stage",
+            "# TYPE neuralbot_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'neuralbot_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'neuralbot_stage_seconds_sum{{stage="{stage}"}} {histogram.total:.6f}')
+            lines.append(f'neuralbot_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+latency = LatencyRecorder(config.TRACE_SLOW_SECONDS, config.TRACE_EXEMPLARS)
+metrics.register("latency", latency.stats)
@@ -0,0 +1,90 @@
+"""
+Последовательная обработка запросов к AI одного пользователя
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+import config
+import metrics
+
+POLICIES = ("queue", "reject", "cancel")
+
+
+class UserBusyError(Exception):
+    """Предыдущий запрос пользователя еще выполняется (политика reject)"""
+
+
+class _UserSlot:
+    __slots__ = ("lock", "tasks")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # Задачи, которые держат или ждут блокировку
+        self.tasks: set[asyncio.Task] = set()
+
+
+class UserLocks:
+    """
+    Блокировка на пользователя с настраиваемой политикой:
+    queue — новый запрос ждет окончания предыдущего,
+    reject — новый запрос отклоняется с UserBusyError,
+    cancel — предыдущие запросы отменяются, выполняется новый.
+    Блокировка удаляется, как только у пользователя не осталось запросов.
+    """
+
+    def __init__(self, policy: str):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown user request policy: {policy}")
+        self.policy = policy
+        self._slots: dict[int, _UserSlot] = {}
+        self.contended = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        """Выполнить блок, пока другие запросы пользователя не работают с его историей"""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = _UserSlot()
+
+        if slot.tasks:
+            self.contended += 1
+            if self.policy == "reject":
+                self.rejected += 1
+                raise UserBusyError()
+            if self.policy == "cancel":
+                self.cancel(user_id)
+
+        task = asyncio.current_task()
+        slot.tasks.add(task)
+        try:
+            async with slot.lock:
+                yield
+        finally:
+            slot.tasks.discard(task)
+            if not slot.tasks and self._slots.get(user_id) is slot:
+                del self._slots[user_id]
+
+    def cancel(self, user_id: int) -> int:
+        """Отменить выполняемые и ждущие запросы пользователя; вернуть их число"""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            return 0
+        for task in slot.tasks:
+            task.cancel()
+        self.cancelled += len(slot.tasks)
+        return len(slot.tasks)
+
+    def stats(self) -> dict:
+        """Состояние блокировок"""
+        return {
+            "active_users": len(self._slots),
+            "contended": self.contended,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+        }
+
+
+user_locks = UserLocks(config.USER_REQUEST_POLICY)
+metrics.register("user_locks", user_locks.stats)